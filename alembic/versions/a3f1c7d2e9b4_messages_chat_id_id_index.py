@@ -0,0 +1,28 @@
+"""messages chat_id id index
+
+Revision ID: a3f1c7d2e9b4
+Revises: 62de5c43553f
+Create Date: 2026-10-18 10:12:41.207315
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3f1c7d2e9b4'
+down_revision: Union[str, None] = '62de5c43553f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
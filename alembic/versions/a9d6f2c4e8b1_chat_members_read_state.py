@@ -0,0 +1,36 @@
+"""chat_members read state
+
+Revision ID: a9d6f2c4e8b1
+Revises: f7b4d0e2a9c5
+Create Date: 2026-10-18 17:26:08.915473
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9d6f2c4e8b1'
+down_revision: Union[str, None] = 'f7b4d0e2a9c5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_members', sa.Column('last_read_message_id', sa.Integer(), nullable=True))
+    op.add_column('chat_members', sa.Column('unread_count', sa.Integer(), server_default='0', nullable=False))
+    # Состояния прочтения раньше не было: вся существующая история считается прочитанной
+    op.execute("""
+        UPDATE chat_members SET last_read_message_id = (
+            SELECT max(messages.id) FROM messages WHERE messages.chat_id = chat_members.chat_id
+        )
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_members', 'unread_count')
+    op.drop_column('chat_members', 'last_read_message_id')
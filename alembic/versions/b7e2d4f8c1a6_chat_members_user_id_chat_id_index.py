@@ -0,0 +1,28 @@
+"""chat_members user_id chat_id index
+
+Revision ID: b7e2d4f8c1a6
+Revises: a3f1c7d2e9b4
+Create Date: 2026-10-18 11:03:17.552904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d4f8c1a6'
+down_revision: Union[str, None] = 'a3f1c7d2e9b4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_chat_members_user_id_chat_id', 'chat_members', ['user_id', 'chat_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_members_user_id_chat_id', table_name='chat_members')
@@ -0,0 +1,37 @@
+"""messages search_vector for full-text search
+
+Revision ID: c4e8a1f5d2b7
+Revises: b7e2d4f8c1a6
+Create Date: 2026-10-18 14:21:40.118305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e8a1f5d2b7'
+down_revision: Union[str, None] = 'b7e2d4f8c1a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Генерируемый столбец заполняется для существующих строк при добавлении (перезапись таблицы)
+    op.add_column('messages', sa.Column(
+        'search_vector', postgresql.TSVECTOR(),
+        sa.Computed("to_tsvector('simple', content)", persisted=True),
+        nullable=True
+    ))
+    op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False,
+                    postgresql_using='gin')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_search_vector', table_name='messages', postgresql_using='gin')
+    op.drop_column('messages', 'search_vector')
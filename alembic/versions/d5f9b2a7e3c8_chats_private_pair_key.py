@@ -0,0 +1,57 @@
+"""chats private pair key
+
+Revision ID: d5f9b2a7e3c8
+Revises: c4e8a1f5d2b7
+Create Date: 2026-10-18 15:02:11.630417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5f9b2a7e3c8'
+down_revision: Union[str, None] = 'c4e8a1f5d2b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('min_user_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('max_user_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('chats_min_user_id_fkey', 'chats', 'users', ['min_user_id'], ['id'])
+    op.create_foreign_key('chats_max_user_id_fkey', 'chats', 'users', ['max_user_id'], ['id'])
+
+    # Ключ пары получают личные чаты ровно с двумя участниками. Если для пары
+    # уже создано несколько чатов, ключ получает самый старый, остальные остаются без него.
+    op.execute("""
+        WITH pairs AS (
+            SELECT chat_members.chat_id, min(chat_members.user_id) AS low, max(chat_members.user_id) AS high
+            FROM chat_members
+            JOIN chats ON chats.id = chat_members.chat_id
+            WHERE NOT chats.is_group_chat
+            GROUP BY chat_members.chat_id
+            HAVING count(DISTINCT chat_members.user_id) = 2
+        ), canonical AS (
+            SELECT DISTINCT ON (low, high) chat_id, low, high
+            FROM pairs
+            ORDER BY low, high, chat_id
+        )
+        UPDATE chats SET min_user_id = canonical.low, max_user_id = canonical.high
+        FROM canonical
+        WHERE chats.id = canonical.chat_id
+    """)
+
+    op.create_index('ix_chats_private_pair', 'chats', ['min_user_id', 'max_user_id'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chats_private_pair', table_name='chats')
+    op.drop_constraint('chats_max_user_id_fkey', 'chats', type_='foreignkey')
+    op.drop_constraint('chats_min_user_id_fkey', 'chats', type_='foreignkey')
+    op.drop_column('chats', 'max_user_id')
+    op.drop_column('chats', 'min_user_id')
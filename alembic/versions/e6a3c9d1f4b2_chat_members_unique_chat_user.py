@@ -0,0 +1,36 @@
+"""chat_members unique chat_id user_id
+
+Revision ID: e6a3c9d1f4b2
+Revises: d5f9b2a7e3c8
+Create Date: 2026-10-18 15:47:29.804112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a3c9d1f4b2'
+down_revision: Union[str, None] = 'd5f9b2a7e3c8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Дубликаты членства (параллельные добавления до появления ограничения): оставляем самую раннюю запись
+    op.execute("""
+        DELETE FROM chat_members duplicate
+        USING chat_members original
+        WHERE duplicate.chat_id = original.chat_id
+          AND duplicate.user_id = original.user_id
+          AND duplicate.id > original.id
+    """)
+    op.create_unique_constraint('uq_chat_members_chat_id_user_id', 'chat_members', ['chat_id', 'user_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_chat_members_chat_id_user_id', 'chat_members', type_='unique')
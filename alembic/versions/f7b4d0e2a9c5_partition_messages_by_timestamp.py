@@ -0,0 +1,120 @@
+"""partition messages by timestamp
+
+Revision ID: f7b4d0e2a9c5
+Revises: e6a3c9d1f4b2
+Create Date: 2026-10-18 16:40:52.371906
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f7b4d0e2a9c5'
+down_revision: Union[str, None] = 'e6a3c9d1f4b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Секции создаются на столько месяцев вперед; дальше их создает `python -m app.partitions create`
+MONTHS_AHEAD = 3
+
+MESSAGES_COLUMNS = """
+    id integer NOT NULL DEFAULT nextval('messages_id_seq'::regclass),
+    chat_id integer NOT NULL REFERENCES chats (id),
+    sender_id integer NOT NULL REFERENCES users (id),
+    content text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL DEFAULT now(),
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED
+"""
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def _create_message_indexes(table: str) -> None:
+    op.create_index('ix_messages_id', table, ['id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', table, ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_search_vector', table, ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def _drop_message_indexes(table: str) -> None:
+    op.drop_index('ix_messages_search_vector', table_name=table, postgresql_using='gin')
+    op.drop_index('ix_messages_chat_id_id', table_name=table)
+    op.drop_index('ix_messages_id', table_name=table)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    op.execute('ALTER TABLE messages RENAME TO messages_legacy')
+    op.execute('ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey')
+    # Освобождаем имена внешних ключей, иначе новая таблица получит messages_*_fkey1
+    op.execute('ALTER TABLE messages_legacy DROP CONSTRAINT messages_chat_id_fkey')
+    op.execute('ALTER TABLE messages_legacy DROP CONSTRAINT messages_sender_id_fkey')
+    _drop_message_indexes('messages_legacy')
+    # В старой таблице timestamp допускал NULL, а в секционированной он входит в первичный
+    # ключ. Такие строки получают время миграции (попадают в секцию текущего месяца);
+    # заполняем до копирования, чтобы INSERT ... SELECT не упал на NOT NULL
+    op.execute('UPDATE messages_legacy SET "timestamp" = now() WHERE "timestamp" IS NULL')
+
+    # Первичный ключ секционированной таблицы обязан включать ключ секционирования
+    op.execute(f"""
+        CREATE TABLE messages ({MESSAGES_COLUMNS},
+            CONSTRAINT messages_pkey PRIMARY KEY (id, "timestamp")
+        ) PARTITION BY RANGE ("timestamp")
+    """)
+
+    # Помесячные секции (UTC) от самого старого сообщения до MONTHS_AHEAD месяцев вперед;
+    # секция по умолчанию принимает строки, для которых секцию не создали вовремя
+    oldest = bind.execute(sa.text('SELECT min("timestamp") FROM messages_legacy')).scalar()
+    now = datetime.now(timezone.utc)
+    month = _month_start(oldest or now)
+    last = _add_months(_month_start(now), MONTHS_AHEAD)
+    while month <= last:
+        upper = _add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE messages_{month:%Y_%m} PARTITION OF messages "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+        )
+        month = upper
+    op.execute('CREATE TABLE messages_default PARTITION OF messages DEFAULT')
+
+    op.execute("""
+        INSERT INTO messages (id, chat_id, sender_id, content, "timestamp")
+        SELECT id, chat_id, sender_id, content, "timestamp" FROM messages_legacy
+    """)
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages.id')
+    op.execute('DROP TABLE messages_legacy')
+
+    # Индексы на секционированной таблице создаются в каждой секции (после загрузки данных - быстрее)
+    _create_message_indexes('messages')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute(f"""
+        CREATE TABLE messages_unpartitioned ({MESSAGES_COLUMNS},
+            CONSTRAINT messages_unpartitioned_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("""
+        INSERT INTO messages_unpartitioned (id, chat_id, sender_id, content, "timestamp")
+        SELECT id, chat_id, sender_id, content, "timestamp" FROM messages
+    """)
+    op.execute('ALTER SEQUENCE messages_id_seq OWNED BY messages_unpartitioned.id')
+    # Удаляет и все секции
+    op.execute('DROP TABLE messages')
+    op.execute('ALTER TABLE messages_unpartitioned RENAME TO messages')
+    op.execute('ALTER TABLE messages RENAME CONSTRAINT messages_unpartitioned_pkey TO messages_pkey')
+    op.execute('ALTER TABLE messages RENAME CONSTRAINT messages_unpartitioned_chat_id_fkey TO messages_chat_id_fkey')
+    op.execute('ALTER TABLE messages RENAME CONSTRAINT messages_unpartitioned_sender_id_fkey TO messages_sender_id_fkey')
+    _create_message_indexes('messages')
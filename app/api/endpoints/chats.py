@@ -1,21 +1,26 @@
-import json
+import zlib
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, List, Optional
 
 from app import crud, schemas, models
-from app.database import get_db
+from app.config import settings
+from app.database import AsyncSessionLocal, get_async_db
 from app.auth.router import get_current_user
 from app.api.websockets.ws_manager import manager
+from app.api.websockets.frames import OutboundFrame
+from app.api.websockets.chat import read_receipt_payload
 
 router = APIRouter()
 
 
 @router.post("/chats/", response_model=schemas.Chat, status_code=status.HTTP_201_CREATED)
-def create_new_chat(
+async def create_new_chat(
         chat_create: schemas.ChatCreate,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
     """
@@ -29,7 +34,18 @@ def create_new_chat(
         if not chat_create.name:
             raise HTTPException(status_code=400, detail="Название группы обязательно для группового чата.")
         # Создаем групповой чат
-        db_chat = crud.create_chat(db=db, chat=chat_create, creator_id=current_user.id)
+        db_chat = await crud.create_chat(db=db, chat=chat_create, creator_id=current_user.id)
+        await manager.membership_changed(db_chat.id)
+
+        # Приглашения всем добавленным участникам - одной рассылкой
+        invitee_ids = [member.user_id for member in db_chat.members if member.user_id != current_user.id]
+        if invitee_ids:
+            await manager.send_to_users(OutboundFrame({
+                "type": "chat_invite_notification",
+                "chat_id": db_chat.id,
+                "chat_name": db_chat.name or "Unnamed Group",
+                "inviter_username": current_user.username
+            }), invitee_ids)
     else:
         # Создаем личный чат
         if not chat_create.target_user_id:
@@ -38,65 +54,71 @@ def create_new_chat(
         if chat_create.target_user_id == current_user.id:
             raise HTTPException(status_code=400, detail="Нельзя создать личный чат с самим собой.")
 
-        target_user = crud.get_user(db, chat_create.target_user_id)
+        target_user = await crud.get_user(db, chat_create.target_user_id)
         if not target_user:
             raise HTTPException(status_code=404, detail="Целевой пользователь не найден.")
 
-        # Проверяем, существует ли уже личный чат между этими двумя пользователями
-        existing_chat = crud.get_private_chat_between_users(db, current_user.id, chat_create.target_user_id)
-        if existing_chat:
-            return existing_chat  # Возвращаем существующий чат
-
-        # Создаем новый личный чат
-        chat_create.name = None  # Личные чаты обычно не имеют названия
-        db_chat = crud.create_chat(db=db, chat=chat_create, creator_id=current_user.id)
-        # Добавляем второго участника
-        crud.add_chat_member(db, chat_id=db_chat.id, user_id=chat_create.target_user_id)
+        # Существующий личный чат этой пары возвращается, иначе создается вместе с обоими участниками
+        db_chat, created = await crud.get_or_create_private_chat(db, current_user.id, chat_create.target_user_id)
+        if created:
+            await manager.membership_changed(db_chat.id)
 
     return db_chat
 
 
-@router.get("/chats/", response_model=List[schemas.Chat])
-def get_user_chats(
-        db: Session = Depends(get_db),
+@router.get("/chats/", response_model=List[schemas.ChatSummary], response_class=ORJSONResponse)
+async def get_user_chats(
+        db: AsyncSession = Depends(get_async_db),
+        current_user: models.User = Depends(get_current_user)
+):
+    """
+    Получает краткий список чатов текущего пользователя: число участников,
+    последнее сообщение и собеседника для личных чатов. История не загружается.
+    """
+    return await crud.get_user_chat_summaries(db, user_id=current_user.id)
+
+
+@router.get("/chats/unread", response_model=List[schemas.ChatReadState], response_class=ORJSONResponse)
+async def get_unread_counts(
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
-    """Получает все чаты, в которых состоит текущий аутентифицированный пользователь."""
-    chats = crud.get_user_chats(db, user_id=current_user.id)
-    return chats
+    """Счетчики непрочитанных сообщений по всем чатам текущего пользователя."""
+    return await crud.get_unread_counts(db, user_id=current_user.id)
 
 
 @router.get("/chats/{chat_id}", response_model=schemas.Chat)
-def get_chat_by_id(
+async def get_chat_by_id(
         chat_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
     """Получает информацию о конкретном чате по ID."""
-    db_chat = crud.get_chat(db, chat_id=chat_id)
-    if not db_chat:
-        raise HTTPException(status_code=404, detail="Чат не найден.")
-
     # Проверяем, является ли текущий пользователь участником этого чата
-    is_member = any(member.user_id == current_user.id for member in db_chat.members)
+    is_member = await crud.is_chat_member(db, chat_id, current_user.id)
+    if is_member is None:
+        raise HTTPException(status_code=404, detail="Чат не найден.")
     if not is_member:
         raise HTTPException(status_code=403, detail="У вас нет доступа к этому чату.")
 
+    db_chat = await crud.get_chat(db, chat_id=chat_id)
+    if not db_chat:
+        raise HTTPException(status_code=404, detail="Чат не найден.")
     return db_chat
 
 
 @router.post("/chats/{chat_id}/members", response_model=schemas.ChatMember, status_code=status.HTTP_201_CREATED)
-async def add_member_to_chat(  # Добавляем async, так как будем использовать await
+async def add_member_to_chat(
         chat_id: int,
         user_id_to_add: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
     """
     Добавляет пользователя в групповой чат.
     Только создатель группы может приглашать других пользователей.
     """
-    db_chat = crud.get_chat(db, chat_id=chat_id)
+    db_chat = await crud.get_chat(db, chat_id=chat_id)
     if not db_chat:
         raise HTTPException(status_code=404, detail="Чат не найден.")
 
@@ -106,15 +128,17 @@ async def add_member_to_chat(  # Добавляем async, так как буд
     if db_chat.creator_id != current_user.id:
         raise HTTPException(status_code=403, detail="Только создатель чата может добавлять участников.")
 
-    user_to_add = crud.get_user(db, user_id_to_add)
+    user_to_add = await crud.get_user(db, user_id_to_add)
     if not user_to_add:
         raise HTTPException(status_code=404, detail="Добавляемый пользователь не найден.")
 
-    is_already_member = any(member.user_id == user_id_to_add for member in db_chat.members)
+    is_already_member = await crud.is_chat_member(db, chat_id, user_id_to_add)
     if is_already_member:
         raise HTTPException(status_code=400, detail="Пользователь уже является участником этого чата.")
 
-    db_chat_member = crud.add_chat_member(db, chat_id=chat_id, user_id=user_id_to_add)
+    db_chat_member = await crud.add_chat_member(db, chat_id=chat_id, user_id=user_id_to_add)
+    # Другие воркеры должны забыть старый состав до того, как участник получит приглашение
+    await manager.membership_changed(chat_id)
 
     # --- НОВОЕ: Отправляем уведомление новому участнику через WebSocket ---
     notification_message = {
@@ -123,24 +147,24 @@ async def add_member_to_chat(  # Добавляем async, так как буд
         "chat_name": db_chat.name or "Unnamed Group",
         "inviter_username": current_user.username
     }
-    await manager.send_personal_message(json.dumps(notification_message), user_id_to_add)
+    await manager.send_personal_message(OutboundFrame(notification_message), user_id_to_add)
     # ---------------------------------------------------------------------
 
     return db_chat_member
 
 
 @router.delete("/chats/{chat_id}/members/{user_id_to_remove}", status_code=status.HTTP_204_NO_CONTENT)
-def remove_member_from_chat(
+async def remove_member_from_chat(
         chat_id: int,
         user_id_to_remove: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
     """
     Удаляет пользователя из группового чата.
     Только создатель группы может удалить других пользователей.
     """
-    db_chat = crud.get_chat(db, chat_id=chat_id)
+    db_chat = await crud.get_chat(db, chat_id=chat_id)
     if not db_chat:
         raise HTTPException(status_code=404, detail="Чат не найден.")
 
@@ -156,43 +180,156 @@ def remove_member_from_chat(
         raise HTTPException(status_code=400, detail="Создатель не может быть удален из группы таким образом.")
 
     # Проверяем, является ли удаляемый пользователь членом чата
-    is_member = any(member.user_id == user_id_to_remove for member in db_chat.members)
+    is_member = await crud.is_chat_member(db, chat_id, user_id_to_remove)
     if not is_member:
         raise HTTPException(status_code=404, detail="Пользователь не является участником этого чата.")
 
     # Удаляем участника
-    success = crud.remove_chat_member(db, chat_id=chat_id, user_id=user_id_to_remove)
+    success = await crud.remove_chat_member(db, chat_id=chat_id, user_id=user_id_to_remove)
     if not success:
         raise HTTPException(status_code=500, detail="Не удалось удалить пользователя.")
+
+    # Закрываем сокеты удаленного участника, подписанные на этот чат
+    await manager.remove_user_from_chat(chat_id, user_id_to_remove)
     return
 
 
-@router.get("/chats/{chat_id}/messages", response_model=List[schemas.MessageResponse])  # <-- ИЗМЕНИ ЭТО!
-def get_chat_messages(
+@router.post("/chats/{chat_id}/read", response_model=schemas.ChatReadState)
+async def mark_chat_read(
         chat_id: int,
-        db: Session = Depends(get_db),
+        message_id: Optional[int] = None,
+        db: AsyncSession = Depends(get_async_db),
         current_user: models.User = Depends(get_current_user)
 ):
-    chat = crud.get_chat(db, chat_id=chat_id)
-    if not chat:
+    """
+    Отмечает сообщения чата прочитанными до message_id (без него - все) и
+    рассылает уведомление о прочтении остальным участникам чата.
+    """
+    is_member = await crud.is_chat_member(db, chat_id, current_user.id)
+    if is_member is None:
         raise HTTPException(status_code=404, detail="Чат не найден.")
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Вы не являетесь участником этого чата.")
+
+    result = await crud.mark_chat_read(db, chat_id, current_user.id, message_id)
+    if result is None:
+        raise HTTPException(status_code=403, detail="Вы не являетесь участником этого чата.")
+    read_state, advanced = result
+    if advanced:
+        await manager.broadcast_message_to_chat(
+            OutboundFrame(read_receipt_payload(chat_id, current_user.id, read_state.last_read_message_id)), chat_id,
+            exclude_user_id=current_user.id
+        )
+    return read_state
 
+
+@router.get("/chats/{chat_id}/messages", response_model=List[schemas.MessageResponse], response_class=ORJSONResponse)
+async def get_chat_messages(
+        chat_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = Query(50, ge=1, le=200),
+        db: AsyncSession = Depends(get_async_db),
+        current_user: models.User = Depends(get_current_user)
+):
     # Проверяем, является ли текущий пользователь членом чата
-    is_member = any(member.user_id == current_user.id for member in chat.members)
+    is_member = await crud.is_chat_member(db, chat_id, current_user.id)
+    if is_member is None:
+        raise HTTPException(status_code=404, detail="Чат не найден.")
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Вы не являетесь участником этого чата.")
+
+    if before_id is None and after_id is None:
+        # Последняя страница - самый частый запрос, обслуживается из кэша без БД
+        return await crud.get_latest_chat_messages(db, chat_id=chat_id, limit=limit)
+
+    messages = await crud.get_chat_messages(
+        db, chat_id=chat_id, before_id=before_id, after_id=after_id, limit=limit
+    )
+    return [crud.message_to_response(msg) for msg in messages]
+
+def _search_cursor(after_rank: Optional[float], after_id: Optional[int]):
+    if (after_rank is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="Параметры `after_rank` и `after_id` передаются вместе.")
+
+
+@router.get("/chats/{chat_id}/messages/search", response_model=List[schemas.MessageSearchResult],
+            response_class=ORJSONResponse)
+async def search_chat_messages(
+        chat_id: int,
+        q: str = Query(..., min_length=1, max_length=256),
+        after_rank: Optional[float] = None,
+        after_id: Optional[int] = None,
+        limit: int = Query(20, ge=1, le=100),
+        db: AsyncSession = Depends(get_async_db),
+        current_user: models.User = Depends(get_current_user)
+):
+    """
+    Полнотекстовый поиск по сообщениям чата. Результаты отсортированы по релевантности;
+    следующая страница - с `after_rank` и `after_id` последнего результата.
+    """
+    _search_cursor(after_rank, after_id)
+    is_member = await crud.is_chat_member(db, chat_id, current_user.id)
+    if is_member is None:
+        raise HTTPException(status_code=404, detail="Чат не найден.")
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Вы не являетесь участником этого чата.")
+
+    return await crud.search_messages(
+        db, q, user_id=current_user.id, chat_id=chat_id, after_rank=after_rank, after_id=after_id, limit=limit
+    )
+
+
+@router.get("/messages/search", response_model=List[schemas.MessageSearchResult], response_class=ORJSONResponse)
+async def search_messages(
+        q: str = Query(..., min_length=1, max_length=256),
+        after_rank: Optional[float] = None,
+        after_id: Optional[int] = None,
+        limit: int = Query(20, ge=1, le=100),
+        db: AsyncSession = Depends(get_async_db),
+        current_user: models.User = Depends(get_current_user)
+):
+    """Полнотекстовый поиск по сообщениям всех чатов текущего пользователя."""
+    _search_cursor(after_rank, after_id)
+    return await crud.search_messages(
+        db, q, user_id=current_user.id, after_rank=after_rank, after_id=after_id, limit=limit
+    )
+
+
+async def _export_chunks(chat_id: int, compress: bool) -> AsyncIterator[bytes]:
+    # Сессия зависимости закрывается до начала отправки тела, поэтому поток открывает свою
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 - формат gzip
+    async with AsyncSessionLocal() as db:
+        async for rows in crud.stream_chat_messages(db, chat_id, settings.EXPORT_BATCH_SIZE):
+            chunk = b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+@router.get("/chats/{chat_id}/export")
+async def export_chat_messages(
+        chat_id: int,
+        gzip: bool = False,
+        db: AsyncSession = Depends(get_async_db),
+        current_user: models.User = Depends(get_current_user)
+):
+    """
+    Выгружает всю историю чата в формате NDJSON (одно сообщение - одна строка),
+    по желанию сжатую gzip. Ответ передается потоком, память не зависит от размера истории.
+    """
+    is_member = await crud.is_chat_member(db, chat_id, current_user.id)
+    if is_member is None:
+        raise HTTPException(status_code=404, detail="Чат не найден.")
     if not is_member:
         raise HTTPException(status_code=403, detail="Вы не являетесь участником этого чата.")
 
-    messages = crud.get_chat_messages(db, chat_id=chat_id)
-
-    response_messages = []
-    for msg in messages:
-        sender_username = msg.sender.username if msg.sender else f"User {msg.sender_id}"
-        response_messages.append(schemas.MessageResponse(  # <-- И ЗДЕСЬ ИСПОЛЬЗУЙ НОВУЮ СХЕМУ
-            id=msg.id,
-            chat_id=msg.chat_id,
-            sender_id=msg.sender_id,
-            content=msg.content,
-            timestamp=msg.timestamp,
-            sender_username=sender_username  # Вот это поле мы заполняем
-        ))
-    return response_messages
\ No newline at end of file
+    filename = f"chat-{chat_id}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        _export_chunks(chat_id, compress=gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
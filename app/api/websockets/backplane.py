@@ -0,0 +1,245 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Callable, Dict, Iterator, Optional
+
+import asyncpg
+import orjson
+from sqlalchemy import text
+
+from app.config import settings
+from app.database import async_engine
+
+# Событие рассылки: {"origin": ..., "kind": "chat" | "user" | "users" | "membership" | "evict", "target": ...,
+# "frame": payload кадра, "exclude": user_id, которому кадр не доставляется (необязательно)}
+EventHandler = Callable[[dict], None]
+
+WORKER_ID = uuid.uuid4().hex
+
+
+class Backplane:
+    """
+    Канал рассылки между воркерами. Менеджер соединений сам доставляет событие
+    своим сокетам и публикует его в бэкплейн, а бэкплейн доставляет событие
+    остальным воркерам (но не отправителю).
+    """
+    async def start(self, handler: EventHandler):
+        self.handler = handler
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict):
+        raise NotImplementedError
+
+
+class InMemoryBackplane(Backplane):
+    """Один процесс: других воркеров нет, публиковать некуда."""
+    async def publish(self, event: dict):
+        pass
+
+
+class PostgresBackplane(Backplane):
+    """
+    Рассылка через Postgres LISTEN/NOTIFY. Публикация идет через общий пул
+    async_engine, прослушивание - через отдельное соединение asyncpg, которое
+    переподключается при обрыве. Payload NOTIFY ограничен ~8000 байтами:
+    более крупное событие (например, длинное сообщение кириллицей) режется на
+    части "#<origin>:<id>:<номер>:<всего>:<кусок JSON>", которые публикуются одной
+    транзакцией - Postgres доставляет их подряд и по порядку.
+    """
+    MAX_PAYLOAD_BYTES = 7999
+    CHUNK_PREFIX = "#"
+    # Запас под заголовок части
+    CHUNK_HEADER_BYTES = 96
+    # Сколько хранить неполное событие (части теряются только при обрыве LISTEN)
+    PARTIAL_EVENT_TTL_SECONDS = 30.0
+
+    def __init__(self, dsn: str, channel: str):
+        self.dsn = dsn
+        self.channel = channel
+        self._listener_task: Optional[asyncio.Task] = None
+        # id события -> [время первой части, {номер: кусок}]
+        self._partial_events: Dict[str, list] = {}
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            self._listener_task = None
+
+    async def publish(self, event: dict):
+        data = orjson.dumps(event)
+        payloads = [data.decode()] if len(data) <= self.MAX_PAYLOAD_BYTES else list(self._split(data))
+        async with async_engine.connect() as conn:
+            for payload in payloads:
+                await conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                   {"channel": self.channel, "payload": payload})
+            await conn.commit()
+
+    def _split(self, data: bytes) -> Iterator[str]:
+        """Режет JSON события на части по границам символов UTF-8."""
+        size = self.MAX_PAYLOAD_BYTES - self.CHUNK_HEADER_BYTES
+        pieces = []
+        start = 0
+        while start < len(data):
+            end = min(start + size, len(data))
+            # Не разрываем многобайтовый символ: байты продолжения имеют вид 10xxxxxx
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end -= 1
+            pieces.append(data[start:end].decode())
+            start = end
+        event_id = uuid.uuid4().hex
+        for index, piece in enumerate(pieces):
+            yield f"{self.CHUNK_PREFIX}{WORKER_ID}:{event_id}:{index}:{len(pieces)}:{piece}"
+
+    def _on_notification(self, connection, pid, channel, payload):
+        if payload.startswith(self.CHUNK_PREFIX):
+            payload = self._collect_chunk(payload)
+            if payload is None:
+                return
+        event = orjson.loads(payload)
+        if event.get("origin") != WORKER_ID:
+            self.handler(event)
+
+    def _collect_chunk(self, payload: str) -> Optional[str]:
+        """Копит части события; возвращает собранный JSON после последней части."""
+        origin, event_id, index, total, piece = payload[len(self.CHUNK_PREFIX):].split(":", 4)
+        if origin == WORKER_ID:
+            return None
+        now = time.monotonic()
+        for stale_id in [key for key, (started, _) in self._partial_events.items()
+                         if now - started > self.PARTIAL_EVENT_TTL_SECONDS]:
+            del self._partial_events[stale_id]
+        _, pieces = self._partial_events.setdefault(event_id, [now, {}])
+        pieces[int(index)] = piece
+        if len(pieces) < int(total):
+            return None
+        del self._partial_events[event_id]
+        return "".join(pieces[position] for position in range(int(total)))
+
+    async def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                terminated = asyncio.Event()
+                connection.add_termination_listener(lambda _: terminated.set())
+                await connection.add_listener(self.channel, self._on_notification)
+                await terminated.wait()
+                print("Backplane LISTEN connection lost, reconnecting")
+            except asyncio.CancelledError:
+                if connection is not None:
+                    await connection.close()
+                raise
+            except Exception as e:
+                print(f"Backplane LISTEN connection failed: {e}")
+            await asyncio.sleep(1)
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Рассылка между воркерами одной машины через Unix-сокеты. Каждый воркер
+    слушает свой сокет в общем каталоге и пишет события в сокеты остальных.
+    Кадр: 4 байта длины (big-endian) + JSON события.
+    """
+    PEER_REFRESH_SECONDS = 1.0
+
+    def __init__(self, socket_dir: str):
+        self.socket_dir = socket_dir
+        self.path = os.path.join(socket_dir, f"worker-{os.getpid()}.sock")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[str, asyncio.StreamWriter] = {}
+        # Одно подключение к каждому соседу, даже при параллельных публикациях
+        self._connect_locks: Dict[str, asyncio.Lock] = {}
+        self._peer_paths: list = []
+        self._peers_refreshed_at = 0.0
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_peer, path=self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in self._peers.values():
+            writer.close()
+        self._peers.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                data = await reader.readexactly(int.from_bytes(header, "big"))
+                self.handler(orjson.loads(data))
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    def _refresh_peer_paths(self):
+        now = time.monotonic()
+        if now - self._peers_refreshed_at < self.PEER_REFRESH_SECONDS:
+            return
+        self._peers_refreshed_at = now
+        self._peer_paths = [
+            os.path.join(self.socket_dir, name) for name in os.listdir(self.socket_dir)
+            if name.endswith(".sock") and os.path.join(self.socket_dir, name) != self.path
+        ]
+
+    async def publish(self, event: dict):
+        data = orjson.dumps(event)
+        frame = len(data).to_bytes(4, "big") + data
+        self._refresh_peer_paths()
+        for path in self._peer_paths:
+            try:
+                writer = self._peers.get(path)
+                if writer is None:
+                    writer = await self._connect_peer(path)
+                writer.write(frame)
+                await writer.drain()
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет остался от завершившегося воркера
+                self._drop_peer(path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except (ConnectionError, OSError) as e:
+                print(f"Backplane peer {path} failed: {e}")
+                self._drop_peer(path)
+
+    async def _connect_peer(self, path: str) -> asyncio.StreamWriter:
+        async with self._connect_locks.setdefault(path, asyncio.Lock()):
+            writer = self._peers.get(path)
+            if writer is None:
+                _, writer = await asyncio.open_unix_connection(path)
+                self._peers[path] = writer
+            return writer
+
+    def _drop_peer(self, path: str):
+        self._connect_locks.pop(path, None)
+        writer = self._peers.pop(path, None)
+        if writer is not None:
+            writer.close()
+        if path in self._peer_paths:
+            self._peer_paths.remove(path)
+
+
+def create_backplane() -> Backplane:
+    """Создает бэкплейн, выбранный в настройках BROADCAST_BACKPLANE."""
+    if settings.BROADCAST_BACKPLANE == "postgres":
+        return PostgresBackplane(settings.ASYNCPG_DSN, settings.BACKPLANE_PG_CHANNEL)
+    if settings.BROADCAST_BACKPLANE == "unix":
+        return UnixSocketBackplane(settings.BACKPLANE_UNIX_SOCKET_DIR)
+    return InMemoryBackplane()
@@ -1,99 +1,366 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-import json
+import re
+import time
+from typing import Optional
 
-from app.database import get_db
-from app import crud, models, schemas
-from app.auth.router import get_current_user
-from app.api.websockets.ws_manager import manager
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app import crud, metrics, models, schemas
+from app.auth.router import get_user_from_token
+from app.api.websockets.ws_manager import manager, ClientConnection
+from app.api.websockets.frames import OutboundFrame, FrameDecodeError, FrameTooLarge, receive_frame
+from app.message_cache import message_tail_cache
+from app.message_writer import message_writer
 
 router = APIRouter()
 
+# Управляющие символы (кроме \t, \n, \r) и одиночные суррогаты: Postgres не сохраняет
+# NUL и невалидный UTF-8, остальное в тексте сообщения не нужно
+FORBIDDEN_CONTENT_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\ud800-\udfff]")
 
-@router.websocket("/ws/{chat_id}")
-async def websocket_chat_endpoint(
-        websocket: WebSocket,
-        chat_id: int,
-        db: Session = Depends(get_db)
-):
+
+class ConnectionClosedByServer(Exception):
+    """Сервер закрыл соединение (например, за превышение лимитов), цикл приема завершается."""
+
+
+async def authenticate_websocket(websocket: WebSocket) -> Optional[models.User]:
+    """Проверяет токен из query-параметра; при ошибке закрывает сокет с кодом 1008."""
     token = websocket.query_params.get("token")
     if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return None
+
+    # Сессии открываются только на время запроса к БД: соединение из пула
+    # не должно удерживаться всё время жизни сокета.
+    async with AsyncSessionLocal() as db:
+        user = await get_user_from_token(db, token)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    return user
+
+
+async def check_chat_membership(chat_id: int, user_id: int) -> Optional[bool]:
+    """Проверяет членство через кэш. None - чат не найден."""
+    async with AsyncSessionLocal() as db:
+        return await crud.is_chat_member(db, chat_id, user_id)
+
+
+def handle_control_frame(connection: ClientConnection, message_type) -> bool:
+    """Обрабатывает служебные кадры ping/pong. Возвращает True, если кадр обработан."""
+    if message_type == "pong":
+        return True
+    if message_type == "ping":
+        connection.enqueue(OutboundFrame({"type": "pong"}))
+        return True
+    return False
+
+
+async def check_rate_limit(connection: ClientConnection, message_type) -> bool:
+    """
+    Проверяет лимит частоты входящих кадров: сообщения (type "message") и служебные
+    кадры (включая ping/pong и неразобранные кадры, message_type=None) считаются по
+    разным лимитам. При превышении лимита сообщений отправляет кадр ошибки (возвращает
+    False) или закрывает соединение с кодом 1008, в зависимости от настроек. Превышение
+    лимита служебных кадров всегда закрывает соединение: ответ на каждый лишний кадр
+    сам был бы неограниченной работой.
+    """
+    control = message_type != "message"
+    if manager.allow_inbound(connection, control):
+        return True
+    if control or settings.WS_RATE_LIMIT_ACTION == "close":
+        await manager.close_connection(connection, "rate_limited", status.WS_1008_POLICY_VIOLATION)
+        raise ConnectionClosedByServer()
+    connection.enqueue(OutboundFrame({
+        "error": "Rate limit exceeded",
+        "code": "rate_limited",
+        "retry_after": round(manager.retry_after(connection, control), 3)
+    }))
+    return False
+
+
+def content_error(message_content) -> Optional[str]:
+    """Проверяет текст сообщения; возвращает описание ошибки или None."""
+    if not message_content or not isinstance(message_content, str):
+        return "Field 'content' is required"
+    if len(message_content) > settings.WS_MAX_CONTENT_LENGTH:
+        return f"Message content exceeds {settings.WS_MAX_CONTENT_LENGTH} characters"
+    if FORBIDDEN_CONTENT_CHARS.search(message_content):
+        return "Message content contains control characters"
+    return None
+
+
+def message_payload(message_id: int, chat_id: int, sender_id: int, sender_username: str,
+                    content: str, timestamp) -> dict:
+    """Кадр сообщения чата - одинаковый для рассылки и досылки при переподключении."""
+    return {
+        "type": "message",  # Указываем тип
+        "id": message_id,
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "sender_username": sender_username,
+        "content": content,
+        "timestamp": timestamp
+    }
+
+
+def read_receipt_payload(chat_id: int, user_id: int, last_read_message_id: int) -> dict:
+    return {"type": "read", "chat_id": chat_id, "user_id": user_id, "last_read_message_id": last_read_message_id}
+
+
+async def handle_mark_read(connection: ClientConnection, user: models.User, chat_id: int, message_id):
+    """
+    Отмечает чат прочитанным до message_id (без него - до последнего сообщения).
+    Отправителю возвращается {"type": "read_state", ...} с новым счетчиком, а при
+    сдвиге границы уведомление {"type": "read"} получают остальные подписчики
+    чата - только его участники.
+    """
+    if message_id is not None and not isinstance(message_id, int):
+        connection.enqueue(OutboundFrame({"error": "Field 'message_id' must be an integer", "chat_id": chat_id}))
         return
+    async with AsyncSessionLocal() as db:
+        result = await crud.mark_chat_read(db, chat_id, user.id, message_id)
+    if result is None:
+        connection.enqueue(OutboundFrame({"error": "Not a member of this chat", "chat_id": chat_id}))
+        return
+    read_state, advanced = result
+    connection.enqueue(OutboundFrame({"type": "read_state", **read_state.model_dump()}))
+    if advanced:
+        await manager.broadcast_message_to_chat(
+            OutboundFrame(read_receipt_payload(chat_id, user.id, read_state.last_read_message_id)), chat_id,
+            exclude_user_id=user.id
+        )
+
 
-    user: models.User = None
+async def handle_chat_message(connection: ClientConnection, user: models.User, chat_id: int, message_content,
+                              received_at: float):
+    """
+    Сохраняет сообщение и рассылает его подписчикам чата. Если БД отвергла
+    сообщение, отправитель получает кадр ошибки, соединение остается открытым.
+    """
+    metrics.WS_MESSAGES_IN.inc()
+    new_message_schema = schemas.MessageCreate(content=message_content)
     try:
-        from app.auth.security import decode_access_token
-        payload = decode_access_token(token)
-        if payload is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-        user = crud.get_user_by_username(db, username=username)
-        if user is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    except HTTPException:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        if settings.MESSAGE_WRITE_BEHIND:
+            message_id, timestamp = await message_writer.submit(chat_id, user.id, new_message_schema.content,
+                                                               user.username)
+        else:
+            async with AsyncSessionLocal() as db:
+                db_message = await crud.create_message(db, new_message_schema, chat_id, user.id)
+            message_id, timestamp = db_message.id, db_message.timestamp
+    except SQLAlchemyError as e:
+        print(f"Failed to save message of user {user.username} in chat {chat_id}: {e}")
+        connection.enqueue(OutboundFrame({"error": "Message could not be saved", "chat_id": chat_id}))
+        return
+    metrics.MESSAGE_PERSIST_SECONDS.observe(time.perf_counter() - received_at)
+
+    message_to_send = message_payload(message_id, chat_id, user.id, user.username,
+                                      new_message_schema.content, timestamp)
+
+    # Кадр кодируется не более одного раза на формат и разделяется между всеми получателями
+    await manager.broadcast_message_to_chat(OutboundFrame(message_to_send), chat_id)
+
+
+async def replay_missed_messages(connection: ClientConnection, chat_id: int, last_message_id: int):
+    """
+    Досылает сообщения чата с id > last_message_id одним кадром
+    {"type": "replay", "chat_id", "messages": [...], "complete"}. Вызывается сразу
+    после подписки: из кэша последних сообщений - без await, поэтому новые сообщения
+    придут уже после досылки; из БД - новые сообщения могут прийти раньше, клиент
+    убирает дубли по id.
+    complete=false - разрыв больше WS_REPLAY_MAX_DB_MESSAGES, остальное клиент
+    догружает через GET /api/chats/{chat_id}/messages?after_id=...
+    """
+    cached = message_tail_cache.since(chat_id, last_message_id)
+    complete = True
+    if cached is not None:
+        messages = [
+            message_payload(message.id, message.chat_id, message.sender_id, message.sender_username,
+                            message.content, message.timestamp)
+            for message in cached
+        ]
+    else:
+        limit = settings.WS_REPLAY_MAX_DB_MESSAGES
+        async with AsyncSessionLocal() as db:
+            db_messages = await crud.get_chat_messages(db, chat_id, after_id=last_message_id, limit=limit + 1)
+        complete = len(db_messages) <= limit
+        messages = [
+            message_payload(message.id, message.chat_id, message.sender_id, message.sender.username,
+                            message.content, message.timestamp)
+            for message in db_messages[:limit]
+        ]
+    connection.enqueue(OutboundFrame({
+        "type": "replay", "chat_id": chat_id, "messages": messages, "complete": complete
+    }))
+
+
+@router.websocket("/ws")
+async def websocket_multiplexed_endpoint(websocket: WebSocket):
+    """
+    Одно соединение на пользователя для любого числа чатов. Клиент управляет
+    подписками кадрами {"type": "subscribe" | "unsubscribe", "chat_id": N} и
+    отправляет {"type": "message", "chat_id": N, "content": ...}. Все исходящие
+    кадры содержат chat_id. При переподключении subscribe может содержать
+    "last_message_id" - пропущенные сообщения будут досланы кадром replay.
+    Прочтение отмечается кадром {"type": "mark_read", "chat_id": N, "message_id": M}.
+    """
+    user = await authenticate_websocket(websocket)
+    if user is None:
+        return
+
+    connection = await manager.connect(user.id, websocket)
+    print(f"Multiplexed WebSocket connected for user {user.username}")
+
+    try:
+        while True:
+            try:
+                message_data = await receive_frame(websocket, max_size=settings.WS_MAX_FRAME_BYTES)
+            except FrameDecodeError:
+                connection.touch()
+                await check_rate_limit(connection, None)
+                connection.enqueue(OutboundFrame({"error": "Message must be a valid JSON or MessagePack object"}))
+                continue
+            connection.touch()
+            received_at = time.perf_counter()
+
+            message_type = message_data.get("type", "message")
+            if not await check_rate_limit(connection, message_type):
+                continue
+            if handle_control_frame(connection, message_type):
+                continue
+            chat_id = message_data.get("chat_id")
+
+            if not isinstance(chat_id, int):
+                connection.enqueue(OutboundFrame({"error": "Field 'chat_id' must be an integer"}))
+                continue
+
+            if message_type == "subscribe":
+                last_message_id = message_data.get("last_message_id")
+                if last_message_id is not None and not isinstance(last_message_id, int):
+                    connection.enqueue(OutboundFrame({"error": "Field 'last_message_id' must be an integer",
+                                                      "chat_id": chat_id}))
+                    continue
+                if chat_id not in connection.chat_ids:
+                    is_member = await check_chat_membership(chat_id, user.id)
+                    if is_member is None:
+                        connection.enqueue(OutboundFrame({"error": "Chat not found", "chat_id": chat_id}))
+                        continue
+                    if not is_member:
+                        connection.enqueue(OutboundFrame({"error": "Not a member of this chat", "chat_id": chat_id}))
+                        continue
+                    manager.subscribe(connection, chat_id)
+                connection.enqueue(OutboundFrame({"type": "subscribed", "chat_id": chat_id}))
+                if last_message_id is not None:
+                    await replay_missed_messages(connection, chat_id, last_message_id)
+
+            elif message_type == "unsubscribe":
+                manager.unsubscribe(connection, chat_id)
+                connection.enqueue(OutboundFrame({"type": "unsubscribed", "chat_id": chat_id}))
+
+            elif message_type == "message":
+                message_content = message_data.get("content")
+                if chat_id not in connection.chat_ids:
+                    connection.enqueue(OutboundFrame({"error": "Not subscribed to this chat", "chat_id": chat_id}))
+                    continue
+                error = content_error(message_content)
+                if error:
+                    connection.enqueue(OutboundFrame({"error": error, "chat_id": chat_id}))
+                    continue
+                await handle_chat_message(connection, user, chat_id, message_content, received_at)
+
+            elif message_type == "mark_read":
+                if chat_id not in connection.chat_ids:
+                    connection.enqueue(OutboundFrame({"error": "Not subscribed to this chat", "chat_id": chat_id}))
+                    continue
+                await handle_mark_read(connection, user, chat_id, message_data.get("message_id"))
+
+            else:
+                connection.enqueue(OutboundFrame({"error": f"Unknown message type '{message_type}'"}))
+
+    except ConnectionClosedByServer:
+        print(f"Multiplexed WebSocket of user {user.username} closed by server")
+    except FrameTooLarge:
+        await manager.close_connection(connection, "frame_too_large", status.WS_1009_MESSAGE_TOO_BIG)
+        print(f"Multiplexed WebSocket of user {user.username} closed: frame too large")
+    except WebSocketDisconnect:
+        manager.disconnect(connection)
+        print(f"Multiplexed WebSocket disconnected for user {user.username}")
+    except Exception as e:
+        print(f"Multiplexed WebSocket error for user {user.username}: {e}")
+        manager.disconnect(connection)
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+
+
+@router.websocket("/ws/{chat_id}")
+async def websocket_chat_endpoint(
+        websocket: WebSocket,
+        chat_id: int,
+        last_message_id: Optional[int] = None
+):
+    user = await authenticate_websocket(websocket)
+    if user is None:
         return
 
-    chat = crud.get_chat(db, chat_id)
-    if not chat:
+    is_member = await check_chat_membership(chat_id, user.id)
+    if is_member is None:
         await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
         print(f"Chat {chat_id} not found.")
         return
 
-    is_member = any(member.user_id == user.id for member in chat.members)
     if not is_member:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         print(f"User {user.username} (ID: {user.id}) is not a member of chat {chat_id}.")
         return
 
-    await manager.connect(user.id, websocket)
+    connection: ClientConnection = await manager.connect(user.id, websocket, chat_id=chat_id)
     print(f"WebSocket connected for user {user.username} to chat {chat_id}")
+    if last_message_id is not None:
+        await replay_missed_messages(connection, chat_id, last_message_id)
 
     try:
         while True:
-            data = await websocket.receive_text()
-            print(f"Received message from user {user.username} in chat {chat_id}: {data}")
-
             try:
-                message_data = json.loads(data)
-                message_type = message_data.get("type", "message")  # Ожидаем тип, по умолчанию "message"
-                message_content = message_data.get("content")
-
-                if message_type != "message" or not message_content:
-                    await websocket.send_text(
-                        json.dumps({"error": "Invalid message format, expected type 'message' and 'content'"}))
-                    continue
-
-            except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "Message must be valid JSON"}))
+                message_data = await receive_frame(websocket, max_size=settings.WS_MAX_FRAME_BYTES)
+            except FrameDecodeError:
+                connection.touch()
+                await check_rate_limit(connection, None)
+                connection.enqueue(OutboundFrame({"error": "Message must be a valid JSON or MessagePack object"}))
                 continue
+            connection.touch()
+            received_at = time.perf_counter()
+            print(f"Received message from user {user.username} in chat {chat_id}: {message_data}")
 
-            # Сохраняем сообщение в БД
-            new_message_schema = schemas.MessageCreate(content=message_content)
-            db_message = crud.create_message(db, new_message_schema, chat_id, user.id)
-
-            # Формируем сообщение для рассылки
-            message_to_send = {
-                "type": "message",  # Указываем тип
-                "chat_id": db_message.chat_id,
-                "sender_id": db_message.sender_id,
-                "sender_username": user.username,
-                "content": db_message.content,
-                "timestamp": db_message.timestamp.isoformat()
-            }
+            message_type = message_data.get("type", "message")  # Ожидаем тип, по умолчанию "message"
+            if not await check_rate_limit(connection, message_type):
+                continue
+            if handle_control_frame(connection, message_type):
+                continue
+            if message_type == "mark_read":
+                await handle_mark_read(connection, user, chat_id, message_data.get("message_id"))
+                continue
+            message_content = message_data.get("content")
 
-            chat_members = crud.get_chat_members(db, chat_id)
-            member_ids = [member.id for member in chat_members]
+            if message_type != "message" or not message_content:
+                connection.enqueue(
+                    OutboundFrame({"error": "Invalid message format, expected type 'message' and 'content'"}))
+                continue
+            error = content_error(message_content)
+            if error:
+                connection.enqueue(OutboundFrame({"error": error}))
+                continue
 
-            await manager.broadcast_message_to_chat(json.dumps(message_to_send), member_ids)
+            await handle_chat_message(connection, user, chat_id, message_content, received_at)
 
+    except ConnectionClosedByServer:
+        print(f"WebSocket of user {user.username} in chat {chat_id} closed by server")
+    except FrameTooLarge:
+        await manager.close_connection(connection, "frame_too_large", status.WS_1009_MESSAGE_TOO_BIG)
+        print(f"WebSocket of user {user.username} in chat {chat_id} closed: frame too large")
     except WebSocketDisconnect:
-        manager.disconnect(user.id, websocket)
+        manager.disconnect(connection)
         print(f"WebSocket disconnected for user {user.username} from chat {chat_id}")
     except Exception as e:
         print(f"WebSocket error for user {user.username} in chat {chat_id}: {e}")
-        manager.disconnect(user.id, websocket)
-        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
\ No newline at end of file
+        manager.disconnect(connection)
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
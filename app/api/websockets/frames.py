@@ -0,0 +1,97 @@
+from datetime import datetime
+from typing import Any, Optional, Tuple, Union
+
+import msgpack
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Форматы кадров, согласуемые через Sec-WebSocket-Protocol
+JSON = "json"
+MSGPACK = "msgpack"
+SUPPORTED_SUBPROTOCOLS = (MSGPACK, JSON)
+
+
+class FrameDecodeError(ValueError):
+    """Входящий кадр не удалось разобрать."""
+
+
+class FrameTooLarge(Exception):
+    """Входящий кадр превышает допустимый размер."""
+
+
+def _msgpack_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__} to msgpack")
+
+
+class OutboundFrame:
+    """
+    Исходящее сообщение. Кодируется лениво и не более одного раза на формат:
+    один и тот же объект ставится в очереди всех получателей, и каждый формат
+    (JSON-текст или MessagePack-байты) вычисляется только при первой отправке.
+    """
+    __slots__ = ("payload", "_json", "_msgpack")
+
+    def __init__(self, payload: Any):
+        self.payload = payload
+        self._json: Optional[str] = None
+        self._msgpack: Optional[bytes] = None
+
+    @property
+    def frame_type(self) -> str:
+        """Тип кадра для метрик; кадры ошибок поля type не имеют."""
+        if isinstance(self.payload, dict):
+            return self.payload.get("type", "error")
+        return "unknown"
+
+    def encode(self, wire_format: str) -> Union[str, bytes]:
+        if wire_format == MSGPACK:
+            if self._msgpack is None:
+                self._msgpack = msgpack.packb(self.payload, default=_msgpack_default)
+            return self._msgpack
+        if self._json is None:
+            # datetime сериализуется orjson напрямую (RFC 3339)
+            self._json = orjson.dumps(self.payload).decode()
+        return self._json
+
+
+def select_subprotocol(websocket: WebSocket) -> Tuple[str, Optional[str]]:
+    """
+    Выбирает формат кадров по предложенным клиентом подпротоколам.
+    Возвращает (формат, подпротокол для ответа); без предложений - JSON без подпротокола.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    for subprotocol in SUPPORTED_SUBPROTOCOLS:
+        if subprotocol in offered:
+            return subprotocol, subprotocol
+    return JSON, None
+
+
+def decode_frame(data: Union[str, bytes]) -> Any:
+    """Разбирает входящий кадр: текстовые - как JSON, бинарные - как MessagePack."""
+    try:
+        if isinstance(data, bytes):
+            return msgpack.unpackb(data)
+        return orjson.loads(data)
+    except (ValueError, msgpack.UnpackException) as e:
+        raise FrameDecodeError(str(e)) from e
+
+
+async def receive_frame(websocket: WebSocket, max_size: Optional[int] = None) -> Any:
+    """
+    Получает и разбирает следующий кадр любого типа. Размер проверяется до разбора:
+    при превышении max_size (в байтах для бинарных кадров, в символах для текстовых) - FrameTooLarge.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    data = message.get("bytes")
+    if data is None:
+        data = message.get("text")
+    if max_size is not None and len(data) > max_size:
+        raise FrameTooLarge(len(data))
+    frame = decode_frame(data)
+    if not isinstance(frame, dict):
+        raise FrameDecodeError("Frame must be an object")
+    return frame
@@ -1,50 +1,366 @@
-from typing import List, Dict
-from fastapi import WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
-import json
+import asyncio
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set
+from fastapi import WebSocket, status
+
+from app import crud, metrics, schemas
+from app.config import settings
+from app.message_cache import message_tail_cache
+from app.rate_limit import TokenBucket
+from app.api.websockets.backplane import Backplane, WORKER_ID, create_backplane
+from app.api.websockets.frames import JSON, OutboundFrame, select_subprotocol
+
+# Ссылки на фоновые закрытия соединений: без них задачу может собрать сборщик мусора
+_close_tasks: Set[asyncio.Task] = set()
+
+
+def _close_in_background(connection: "ClientConnection", code: int):
+    """Закрывает соединение, не дожидаясь завершения (ошибки close() обрабатывает сам)."""
+    task = asyncio.create_task(connection.close(code=code))
+    _close_tasks.add(task)
+    task.add_done_callback(_close_tasks.discard)
+
+
+class ClientConnection:
+    """
+    Одно WebSocket-соединение с собственной ограниченной очередью исходящих
+    сообщений и отдельной задачей-писателем. Медленный клиент копит очередь
+    у себя и не задерживает доставку остальным участникам чата.
+    Соединение может быть подписано на несколько чатов (мультиплексированный /ws)
+    или ровно на один (/ws/{chat_id}).
+    """
+    def __init__(self, user_id: int, websocket: WebSocket, queue_size: int, overflow_policy: str,
+                 multiplexed: bool = False, wire_format: str = JSON,
+                 on_evict: Optional[Callable[["ClientConnection", str], None]] = None):
+        self.user_id = user_id
+        self.multiplexed = multiplexed
+        self.wire_format = wire_format
+        self.chat_ids: Set[int] = set()
+        self.websocket = websocket
+        self.overflow_policy = overflow_policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        # Время последнего входящего кадра; по нему сборщик находит неотвечающих клиентов
+        self.last_seen = time.monotonic()
+        self.on_evict = on_evict
+        self.rate_limit = TokenBucket(settings.WS_RATE_LIMIT_PER_CONNECTION, settings.WS_RATE_BURST_PER_CONNECTION)
+        # Служебные кадры (подписки, отметки о прочтении) не тратят токены сообщений
+        self.control_rate_limit = TokenBucket(settings.WS_CONTROL_RATE_LIMIT_PER_CONNECTION,
+                                              settings.WS_CONTROL_RATE_BURST_PER_CONNECTION)
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: OutboundFrame) -> bool:
+        """Ставит сообщение в очередь, не дожидаясь отправки. Возвращает False, если соединение закрыто."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if self.overflow_policy == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.put_nowait(message)
+                # Без вывода на каждый кадр: медленный клиент иначе нагружает stdout event loop
+                metrics.WS_DROPPED_FRAMES.inc()
+            else:
+                print(f"Outbound queue full for user {self.user_id}, closing slow connection")
+                self.evict("slow_consumer", status.WS_1013_TRY_AGAIN_LATER)
+                return False
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                data = message.encode(self.wire_format)
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                metrics.WS_FRAMES_OUT.labels(message.frame_type).inc()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Failed to send message to user {self.user_id}: {e}")
+            self.evict("send_failed", status.WS_1011_INTERNAL_ERROR)
+
+    def evict(self, reason: str, code: int):
+        """Закрывает соединение по инициативе сервера и сообщает об этом менеджеру."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.on_evict is not None:
+            self.on_evict(self, reason)
+        _close_in_background(self, code)
+
+    def stop(self):
+        """Останавливает задачу-писателя; недоставленные сообщения отбрасываются."""
+        self.closed = True
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            print(f"Failed to close connection for user {self.user_id}: {e}")
+
 
 class WebSocketConnectionManager:
     """
     Менеджер для управления активными WebSocket-соединениями.
-    Позволяет добавлять, удалять соединения и рассылать сообщения.
+    Соединения проиндексированы и по чату, и по пользователю: рассылка в чат
+    затрагивает только сокеты, подписанные на этот чат.
     """
-    def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-
-    async def connect(self, user_id: int, websocket: WebSocket):
-        """Устанавливает соединение для пользователя."""
-        await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
-        print(f"User {user_id} connected. Total connections for user: {len(self.active_connections[user_id])}")
-
-    def disconnect(self, user_id: int, websocket: WebSocket):
-        """Разрывает соединение для пользователя."""
-        if user_id in self.active_connections and websocket in self.active_connections[user_id]:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-            print(f"User {user_id} disconnected. Remaining connections for user: {self.active_connections.get(user_id, [])}")
-
-
-    async def send_personal_message(self, message: str, user_id: int):
+    # Ограничение размера события бэкплейна при рассылке многим пользователям (NOTIFY до ~8000 байт)
+    USERS_PER_EVENT = 500
+
+    def __init__(self, queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+                 overflow_policy: str = settings.WS_SLOW_CONSUMER_POLICY,
+                 backplane: Optional[Backplane] = None,
+                 heartbeat_interval: float = settings.WS_HEARTBEAT_INTERVAL_SECONDS,
+                 heartbeat_timeout: float = settings.WS_HEARTBEAT_TIMEOUT_SECONDS):
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        # Счетчики соединений, закрытых сервером, по причинам
+        self.evictions: Counter = Counter()
+        self._reaper_task: Optional[asyncio.Task] = None
+        # Доставка событий сокетам других воркеров
+        self.backplane = backplane or create_backplane()
+        # chat_id -> user_id -> соединения пользователя в этом чате
+        self.chat_connections: Dict[int, Dict[int, Set[ClientConnection]]] = {}
+        # user_id -> все соединения пользователя
+        self.user_connections: Dict[int, Set[ClientConnection]] = {}
+        # user_id -> общий лимит входящих кадров для всех соединений пользователя в этом воркере
+        self.user_rate_limits: Dict[int, TokenBucket] = {}
+
+    async def start(self):
+        await self.backplane.start(self._handle_backplane_event)
+        self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def stop(self):
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+        await self.backplane.stop()
+
+    async def _reaper(self):
+        """
+        Периодически отправляет всем соединениям {"type": "ping"} и закрывает те,
+        от которых не было ни одного кадра дольше heartbeat_timeout.
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            deadline = time.monotonic() - self.heartbeat_timeout
+            ping = OutboundFrame({"type": "ping"})
+            for connections in list(self.user_connections.values()):
+                for connection in list(connections):
+                    if connection.last_seen < deadline:
+                        print(f"Connection of user {connection.user_id} is unresponsive, closing")
+                        connection.evict("heartbeat_timeout", status.WS_1001_GOING_AWAY)
+                    else:
+                        connection.enqueue(ping)
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.user_connections.values())
+
+    def allow_inbound(self, connection: ClientConnection, control: bool = False) -> bool:
+        """
+        Списывает токен входящего кадра: сообщения - с лимитов соединения и пользователя,
+        служебные кадры (control=True) - с отдельного лимита соединения.
+        """
+        if control:
+            return connection.control_rate_limit.consume()
+        if not connection.rate_limit.consume():
+            return False
+        user_rate_limit = self.user_rate_limits.get(connection.user_id)
+        return user_rate_limit is None or user_rate_limit.consume()
+
+    def retry_after(self, connection: ClientConnection, control: bool = False) -> float:
+        if control:
+            return connection.control_rate_limit.retry_after()
+        user_rate_limit = self.user_rate_limits.get(connection.user_id)
+        return max(connection.rate_limit.retry_after(),
+                   user_rate_limit.retry_after() if user_rate_limit is not None else 0.0)
+
+    async def close_connection(self, connection: ClientConnection, reason: str, code: int):
+        """Закрывает соединение по инициативе сервера (с учетом в счетчиках)."""
+        self.evictions[reason] += 1
+        metrics.WS_EVICTIONS.labels(reason).inc()
+        connection.stop()
+        self._unregister(connection)
+        await connection.close(code=code)
+
+    def _on_evict(self, connection: ClientConnection, reason: str):
+        self.evictions[reason] += 1
+        metrics.WS_EVICTIONS.labels(reason).inc()
+        self._unregister(connection)
+
+    async def connect(self, user_id: int, websocket: WebSocket, chat_id: Optional[int] = None) -> ClientConnection:
+        """
+        Устанавливает соединение пользователя. С chat_id соединение сразу подписывается
+        на этот чат; без него - мультиплексированное, подписки добавляются через subscribe.
+        """
+        wire_format, subprotocol = select_subprotocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(user_id, websocket, self.queue_size, self.overflow_policy,
+                                      multiplexed=chat_id is None, wire_format=wire_format,
+                                      on_evict=self._on_evict)
+        connection.start()
+        self.user_connections.setdefault(user_id, set()).add(connection)
+        if user_id not in self.user_rate_limits:
+            self.user_rate_limits[user_id] = TokenBucket(settings.WS_RATE_LIMIT_PER_USER,
+                                                         settings.WS_RATE_BURST_PER_USER)
+        if chat_id is not None:
+            self.subscribe(connection, chat_id)
+        print(f"User {user_id} connected. Total connections for user: {len(self.user_connections[user_id])}")
+        return connection
+
+    def subscribe(self, connection: ClientConnection, chat_id: int):
+        """Подписывает соединение на чат (членство проверяет вызывающий)."""
+        connection.chat_ids.add(chat_id)
+        self.chat_connections.setdefault(chat_id, {}).setdefault(connection.user_id, set()).add(connection)
+
+    def unsubscribe(self, connection: ClientConnection, chat_id: int):
+        """Отписывает соединение от чата."""
+        connection.chat_ids.discard(chat_id)
+        chat_users = self.chat_connections.get(chat_id)
+        if chat_users is None:
+            return
+        user_chat_connections = chat_users.get(connection.user_id)
+        if user_chat_connections is not None:
+            user_chat_connections.discard(connection)
+            if not user_chat_connections:
+                del chat_users[connection.user_id]
+        if not chat_users:
+            del self.chat_connections[chat_id]
+
+    def disconnect(self, connection: ClientConnection):
+        """Разрывает соединение и удаляет его из обоих индексов."""
+        connection.stop()
+        self._unregister(connection)
+        print(f"User {connection.user_id} disconnected. "
+              f"Remaining connections for user: {len(self.user_connections.get(connection.user_id, ()))}")
+
+    def _unregister(self, connection: ClientConnection):
+        for chat_id in list(connection.chat_ids):
+            self.unsubscribe(connection, chat_id)
+
+        user_connections = self.user_connections.get(connection.user_id)
+        if user_connections is not None:
+            user_connections.discard(connection)
+            if not user_connections:
+                del self.user_connections[connection.user_id]
+                self.user_rate_limits.pop(connection.user_id, None)
+
+    async def membership_changed(self, chat_id: int):
+        """
+        Сообщает остальным воркерам, что состав чата изменился (чат создан или в него
+        добавлен участник), чтобы они сбросили кэш членства. Локальный кэш crud
+        сбрасывает сам; публиковать нужно до уведомлений новым участникам.
+        """
+        await self._publish("membership", chat_id, None)
+
+    async def remove_user_from_chat(self, chat_id: int, user_id: int):
+        """Закрывает сокеты пользователя, подписанные на чат (например, после исключения из группы)."""
+        self._evict_local(chat_id, user_id)
+        await self._publish("evict", [chat_id, user_id], None)
+
+    async def send_personal_message(self, message: OutboundFrame, user_id: int):
         """Отправляет персональное сообщение всем активным соединениям пользователя."""
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_text(message)
-                except RuntimeError as e:
-                    print(f"Failed to send message to user {user_id}: {e}")
-
-    async def broadcast_message_to_chat(self, message: str, chat_members_ids: List[int]):
-        """Рассылает сообщение всем участникам чата, у которых есть активные соединения."""
-        for user_id in chat_members_ids:
-            if user_id in self.active_connections:
-                for connection in self.active_connections[user_id]:
-                    try:
-                        await connection.send_text(message)
-                    except RuntimeError as e:
-                        print(f"Failed to send message to user {user_id} in broadcast: {e}")
-
-manager = WebSocketConnectionManager()
\ No newline at end of file
+        self._deliver_to_user(message, user_id)
+        await self._publish("user", user_id, message.payload)
+
+    async def send_to_users(self, message: OutboundFrame, user_ids: List[int]):
+        """
+        Отправляет одно сообщение многим пользователям: кадр кодируется один раз,
+        в бэкплейн уходит одно событие на пачку из USERS_PER_EVENT пользователей.
+        """
+        for user_id in user_ids:
+            self._deliver_to_user(message, user_id)
+        for start in range(0, len(user_ids), self.USERS_PER_EVENT):
+            await self._publish("users", user_ids[start:start + self.USERS_PER_EVENT], message.payload)
+
+    async def broadcast_message_to_chat(self, message: OutboundFrame, chat_id: int,
+                                        exclude_user_id: Optional[int] = None):
+        """
+        Рассылает сообщение всем соединениям, подписанным на чат, во всех воркерах,
+        кроме соединений пользователя exclude_user_id (например, автора уведомления).
+        Сообщение только ставится в очереди соединений, отправкой занимаются их писатели.
+        """
+        with metrics.WS_BROADCAST_SECONDS.time():
+            self._deliver_to_chat(message, chat_id, exclude_user_id)
+            await self._publish("chat", chat_id, message.payload, exclude_user_id)
+
+    async def _publish(self, kind: str, target, frame, exclude_user_id: Optional[int] = None):
+        event = {"origin": WORKER_ID, "kind": kind, "target": target, "frame": frame}
+        if exclude_user_id is not None:
+            event["exclude"] = exclude_user_id
+        try:
+            await self.backplane.publish(event)
+        except Exception as e:
+            print(f"Failed to publish {kind} event for {target} to backplane: {e}")
+
+    def _handle_backplane_event(self, event: dict):
+        kind = event["kind"]
+        if kind == "chat":
+            payload = event["frame"]
+            if isinstance(payload, dict) and payload.get("type") == "message":
+                # Сообщение записано другим воркером: в хвост этого воркера оно попадает только
+                # отсюда (свои сообщения crud добавляет в кэш при записи)
+                message_tail_cache.add(schemas.MessageResponse.model_validate(payload))
+            self._deliver_to_chat(OutboundFrame(payload), event["target"], event.get("exclude"))
+        elif kind == "user":
+            self._deliver_to_user(OutboundFrame(event["frame"]), event["target"])
+        elif kind == "users":
+            message = OutboundFrame(event["frame"])
+            for user_id in event["target"]:
+                self._deliver_to_user(message, user_id)
+        elif kind == "membership":
+            crud.membership_cache.invalidate(event["target"])
+        elif kind == "evict":
+            chat_id, user_id = event["target"]
+            # Состав чата изменился в другом воркере: кэш членства здесь устарел
+            crud.membership_cache.invalidate(chat_id)
+            self._evict_local(chat_id, user_id)
+
+    def _deliver_to_chat(self, message: OutboundFrame, chat_id: int, exclude_user_id: Optional[int] = None):
+        # Обход по копиям: переполненное соединение при политике disconnect
+        # удаляется из индексов прямо внутри enqueue
+        for user_id, connections in list(self.chat_connections.get(chat_id, {}).items()):
+            if user_id == exclude_user_id:
+                continue
+            for connection in list(connections):
+                connection.enqueue(message)
+
+    def _deliver_to_user(self, message: OutboundFrame, user_id: int):
+        for connection in list(self.user_connections.get(user_id, ())):
+            connection.enqueue(message)
+
+    def _evict_local(self, chat_id: int, user_id: int):
+        chat_users = self.chat_connections.get(chat_id)
+        if not chat_users:
+            return
+        connections = chat_users.pop(user_id, set())
+        if not chat_users:
+            del self.chat_connections[chat_id]
+        for connection in connections:
+            connection.chat_ids.discard(chat_id)
+            if connection.multiplexed:
+                # Мультиплексированное соединение остается открытым для остальных чатов
+                connection.enqueue(OutboundFrame({"type": "unsubscribed", "chat_id": chat_id, "reason": "removed"}))
+            else:
+                self._unregister(connection)
+                _close_in_background(connection, status.WS_1008_POLICY_VIOLATION)
+
+manager = WebSocketConnectionManager()
+metrics.WS_ACTIVE_CONNECTIONS.set_function(manager.connection_count)
@@ -1,55 +1,99 @@
+from typing import Optional
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import crud, schemas, models
-from app.database import get_db
-from app.auth.security import verify_password, create_access_token, decode_access_token
+from app.cache import TTLCache
+from app.config import settings
+from app.database import get_async_db
+from app.auth.security import (
+    verify_password_async, create_access_token, decode_access_token, PasswordHashingOverloaded
+)
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> models.User:
+def password_overloaded_exception() -> HTTPException:
+    """Ответ при переполненной очереди хэширования паролей."""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Сервис перегружен, повторите попытку позже",
+        headers={"Retry-After": "1"},
+    )
+
+# user_id -> пользователь (отсоединенный от сессии, только для чтения)
+user_cache = TTLCache(ttl=settings.USER_CACHE_TTL_SECONDS, maxsize=settings.USER_CACHE_MAX_SIZE)
+
+async def get_user_from_token(db: AsyncSession, token: str) -> Optional[models.User]:
+    """
+    Возвращает пользователя по токену или None, если токен недействителен.
+    Пользователь ищется по claim `uid` через кэш; токены без `uid` - по имени.
+    """
+    payload = decode_access_token(token)
+    if payload is None:
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+
+    user_id = payload.get("uid")
+    if user_id is not None:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+        user = await crud.get_user(db, user_id)
+    else:
+        user = await crud.get_user_by_username(db, username=username)
+
+    if user is None or user.username != username:
+        return None
+    user_cache.set(user.id, user)
+    return user
+
+async def get_current_user(db: AsyncSession = Depends(get_async_db), token: str = Depends(oauth2_scheme)) -> models.User:
     """Зависимость FastAPI для получения текущего аутентифицированного пользователя."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    payload = decode_access_token(token)
-    if payload is None:
-        raise credentials_exception
-    username: str = payload.get("sub")
-    if username is None:
-        raise credentials_exception
-    user = crud.get_user_by_username(db, username=username)
+    user = await get_user_from_token(db, token)
     if user is None:
         raise credentials_exception
     return user
 
 @router.post("/register", response_model=schemas.UserInDB, status_code=status.HTTP_201_CREATED)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Эндпоинт для регистрации нового пользователя."""
-    db_user = crud.get_user_by_username(db, username=user.username)
+    db_user = await crud.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Имя пользователя уже зарегистрировано")
-    return crud.create_user(db=db, user=user)
+    try:
+        return await crud.create_user(db=db, user=user)
+    except PasswordHashingOverloaded:
+        raise password_overloaded_exception()
 
 @router.post("/token", response_model=schemas.Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Эндпоинт для получения JWT токена (вход в систему)."""
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    user = await crud.get_user_by_username(db, username=form_data.username)
+    try:
+        password_ok = bool(user) and await verify_password_async(form_data.password, user.hashed_password)
+    except PasswordHashingOverloaded:
+        raise password_overloaded_exception()
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверное имя пользователя или пароль",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/me", response_model=schemas.UserInDB)
@@ -1,20 +1,63 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+from app.cache import TTLCache
 from app.config import settings
+from app.metrics import PASSWORD_HASH_SECONDS
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# sha256(token) -> проверенный payload; запись живет не дольше срока действия токена
+verified_token_cache = TTLCache(ttl=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, maxsize=settings.TOKEN_CACHE_MAX_SIZE)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+# bcrypt занимает процессор на сотни миллисекунд, поэтому хэширование выполняется
+# в отдельном пуле потоков (bcrypt отпускает GIL), а не в цикле событий.
+_password_executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+_password_pending = 0
+
+class PasswordHashingOverloaded(Exception):
+    """Очередь на хэширование паролей переполнена."""
+
+async def _run_password_task(func, *args):
+    global _password_pending
+    if _password_pending >= settings.PASSWORD_HASH_MAX_PENDING:
+        raise PasswordHashingOverloaded()
+    _password_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_pending -= 1
+
+def _timed_verify_password(plain_password: str, hashed_password: str) -> bool:
+    with PASSWORD_HASH_SECONDS.labels("verify").time():
+        return verify_password(plain_password, hashed_password)
+
+def _timed_get_password_hash(password: str) -> str:
+    with PASSWORD_HASH_SECONDS.labels("hash").time():
+        return get_password_hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_task(_timed_verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_password_task(_timed_get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -26,8 +69,19 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 def decode_access_token(token: str):
+    """
+    Проверяет подпись и срок действия токена. Успешно проверенные токены
+    кэшируются по дайджесту до истечения `exp`, повторная проверка подписи не нужна.
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = verified_token_cache.get(digest)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        return payload
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+    expires_in = payload.get("exp", 0) - time.time()
+    if expires_in > 0:
+        verified_token_cache.set(digest, payload, ttl=expires_in)
+    return payload
\ No newline at end of file
@@ -1,23 +1,124 @@
+from typing import Literal, Optional
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy.engine import make_url
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
-    DB_USER: str
-    DB_NAME: str
-    DB_PASSWORD: str
-    DB_HOST: str
-    DB_PORT: int
+    DB_USER: Optional[str] = None
+    DB_NAME: Optional[str] = None
+    DB_PASSWORD: Optional[str] = None
+    DB_HOST: Optional[str] = None
+    DB_PORT: Optional[int] = None
+
+    # Полный URL базы вместо DB_* (например, sqlite:///./bench.db для нагрузочных тестов).
+    # Если задан только DATABASE_URL, асинхронный URL выводится из него заменой драйвера.
+    DATABASE_URL: Optional[str] = None
+    ASYNC_DATABASE_URL: Optional[str] = None
+
+    @model_validator(mode="after")
+    def _build_database_urls(self):
+        if self.DATABASE_URL is None:
+            missing = [name for name in ("DB_USER", "DB_NAME", "DB_PASSWORD", "DB_HOST", "DB_PORT")
+                       if getattr(self, name) is None]
+            if missing:
+                raise ValueError(f"Either DATABASE_URL or {', '.join(missing)} must be set")
+            self.DATABASE_URL = (
+                f"postgresql+psycopg2://{self.DB_USER}:{self.DB_PASSWORD}@"
+                f"{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
+            )
+        if self.ASYNC_DATABASE_URL is None:
+            url = make_url(self.DATABASE_URL)
+            async_driver = "sqlite+aiosqlite" if url.get_backend_name() == "sqlite" else "postgresql+asyncpg"
+            self.ASYNC_DATABASE_URL = url.set(drivername=async_driver).render_as_string(hide_password=False)
+        return self
 
     @property
-    def DATABASE_URL(self) -> str:
-        return (
-            f"postgresql+psycopg2://{self.DB_USER}:{self.DB_PASSWORD}@"
-            f"{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
-        )
+    def ASYNCPG_DSN(self) -> str:
+        url = make_url(self.ASYNC_DATABASE_URL).set(drivername="postgresql")
+        return url.render_as_string(hide_password=False)
+
+    # Логирование всех SQL-запросов (только для отладки)
+    DB_ECHO: bool = False
 
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Кэш проверенных токенов и пользователей, найденных по ID из токена
+    TOKEN_CACHE_MAX_SIZE: int = 10000
+    USER_CACHE_TTL_SECONDS: float = 300
+    USER_CACHE_MAX_SIZE: int = 10000
+
+    # Пул потоков для bcrypt: число потоков и максимум задач (в работе + в очереди),
+    # сверх которого вход и регистрация отвечают 503
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_MAX_PENDING: int = 32
+
+    # Исходящая очередь каждого WebSocket-соединения и поведение при её переполнении:
+    # drop_oldest - выбрасывать самое старое сообщение, disconnect - закрывать с кодом 1013.
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SLOW_CONSUMER_POLICY: Literal["drop_oldest", "disconnect"] = "drop_oldest"
+
+    # Сервер шлет {"type": "ping"} каждые WS_HEARTBEAT_INTERVAL_SECONDS; соединение,
+    # не приславшее ни одного кадра за WS_HEARTBEAT_TIMEOUT_SECONDS, закрывается
+    WS_HEARTBEAT_INTERVAL_SECONDS: float = 20
+    WS_HEARTBEAT_TIMEOUT_SECONDS: float = 60
+
+    # Ограничения входящего трафика WebSocket. Кадр больше WS_MAX_FRAME_BYTES закрывает
+    # соединение с кодом 1009 до разбора; при превышении частоты (token bucket на
+    # соединение и на пользователя) клиент получает кадр ошибки (error) или закрытие 1008 (close).
+    # Лимиты RATE_LIMIT/RATE_BURST считают только сообщения; служебные кадры (subscribe,
+    # unsubscribe, mark_read) ограничены отдельным, более свободным лимитом соединения
+    WS_MAX_FRAME_BYTES: int = 16384
+    WS_MAX_CONTENT_LENGTH: int = 4000
+    WS_RATE_LIMIT_PER_CONNECTION: float = 5
+    WS_RATE_BURST_PER_CONNECTION: int = 10
+    WS_RATE_LIMIT_PER_USER: float = 10
+    WS_RATE_BURST_PER_USER: int = 20
+    WS_CONTROL_RATE_LIMIT_PER_CONNECTION: float = 50
+    WS_CONTROL_RATE_BURST_PER_CONNECTION: int = 500
+    WS_RATE_LIMIT_ACTION: Literal["error", "close"] = "error"
+
+    # Досылка пропущенных сообщений при переподключении (last_message_id) идет из кэша
+    # последних сообщений (MESSAGE_CACHE_*); если разрыв больше закэшированного хвоста,
+    # досылается до WS_REPLAY_MAX_DB_MESSAGES из БД
+    WS_REPLAY_MAX_DB_MESSAGES: int = 500
+
+    # Рассылка между воркерами: memory - один процесс, postgres - LISTEN/NOTIFY,
+    # unix - Unix-сокеты в общем каталоге (воркеры на одной машине)
+    BROADCAST_BACKPLANE: Literal["memory", "postgres", "unix"] = "memory"
+    BACKPLANE_PG_CHANNEL: str = "chat_broadcast"
+    BACKPLANE_UNIX_SOCKET_DIR: str = "/tmp/fast_websockets_backplane"
+
+    # Кэш состава участников чатов (инвалидируется при изменении состава в этом воркере)
+    MEMBERSHIP_CACHE_TTL_SECONDS: float = 30
+    MEMBERSHIP_CACHE_MAX_CHATS: int = 10000
+
+    # Кэш последних сообщений активных чатов: до MESSAGE_CACHE_MESSAGES_PER_CHAT сообщений
+    # на чат, суммарно не больше MESSAGE_CACHE_MAX_BYTES (0 - кэш выключен). Пополняется
+    # рассылкой из всех воркеров; TTL лишь ограничивает жизнь хвоста, если событие
+    # бэкплейна потерялось при обрыве соединения
+    MESSAGE_CACHE_MESSAGES_PER_CHAT: int = 200
+    MESSAGE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    MESSAGE_CACHE_TTL_SECONDS: float = 300
+
+    # Помесячные секции messages: `python -m app.partitions create` создает их на
+    # MESSAGE_PARTITION_MONTHS_AHEAD месяцев вперед, `archive` выгружает секции старше
+    # MESSAGE_RETENTION_MONTHS месяцев в MESSAGE_ARCHIVE_DIR и удаляет их
+    MESSAGE_PARTITION_MONTHS_AHEAD: int = 3
+    MESSAGE_RETENTION_MONTHS: int = 24
+    MESSAGE_ARCHIVE_DIR: str = "./archive"
+
+    # Экспорт истории чата читается серверным курсором пачками по EXPORT_BATCH_SIZE строк
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # Отложенная пакетная запись сообщений: входящие сообщения копятся до
+    # MESSAGE_BATCH_FLUSH_INTERVAL_MS и сохраняются одним INSERT
+    MESSAGE_WRITE_BEHIND: bool = False
+    MESSAGE_BATCH_FLUSH_INTERVAL_MS: float = 5
+    MESSAGE_BATCH_MAX_SIZE: int = 500
+
 settings = Settings()
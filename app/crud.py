@@ -1,107 +1,250 @@
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import or_
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Row, bindparam, insert, literal, literal_column, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, noload
 from sqlalchemy.sql import func
 
 from app import models, schemas
-from app.auth.security import get_password_hash
+from app.auth.security import get_password_hash_async
+from app.cache import TTLCache
+from app.config import settings
+from app.message_cache import message_tail_cache
+from app.metrics import track_db
+
+
+# timestamp сообщения - now() транзакции записи, поэтому сообщение с большим id может
+# оказаться чуть старше предыдущего; запас покрывает такие транзакции
+CURSOR_TIMESTAMP_SLACK = timedelta(minutes=5)
+
+# chat_id -> frozenset(user_id) участников чата
+membership_cache = TTLCache(
+    ttl=settings.MEMBERSHIP_CACHE_TTL_SECONDS, maxsize=settings.MEMBERSHIP_CACHE_MAX_CHATS
+)
 
 
-def get_user(db: Session, user_id: int):
+@track_db
+async def get_user(db: AsyncSession, user_id: int):
     """Получает пользователя по ID."""
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    result = await db.execute(select(models.User).filter(models.User.id == user_id))
+    return result.unique().scalars().first()
 
 
-def get_user_by_username(db: Session, username: str):
+@track_db
+async def get_user_by_username(db: AsyncSession, username: str):
     """Получает пользователя по имени пользователя."""
-    return db.query(models.User).filter(models.User.username == username).first()
+    result = await db.execute(select(models.User).filter(models.User.username == username))
+    return result.unique().scalars().first()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
     """Создает нового пользователя в базе данных."""
-    hashed_password = get_password_hash(user.password)
-    db_user = models.User(username=user.username, hashed_password=hashed_password)
+    # Хэширование (bcrypt) - вне замера времени запросов к БД
+    hashed_password = await get_password_hash_async(user.password)
+    return await _insert_user(db, user.username, hashed_password)
+
+
+@track_db
+async def _insert_user(db: AsyncSession, username: str, hashed_password: str):
+    db_user = models.User(username=username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
-def get_chat(db: Session, chat_id: int):
+@track_db
+async def get_chat(db: AsyncSession, chat_id: int):
     """Получает чат по ID."""
-    return db.query(models.Chat).filter(models.Chat.id == chat_id).first()
+    result = await db.execute(select(models.Chat).filter(models.Chat.id == chat_id))
+    return result.unique().scalars().first()
+
+
+@track_db
+async def get_user_chat_summaries(db: AsyncSession, user_id: int):
+    """
+    Получает краткую информацию о чатах пользователя: число участников,
+    последнее сообщение и собеседника в личных чатах.
+    Выполняет фиксированное число запросов независимо от объема истории.
+    """
+    member_count = select(func.count(models.ChatMember.id)).where(
+        models.ChatMember.chat_id == models.Chat.id
+    ).correlate(models.Chat).scalar_subquery()
+    last_message_id = select(func.max(models.Message.id)).where(
+        models.Message.chat_id == models.Chat.id
+    ).correlate(models.Chat).scalar_subquery()
 
+    # Членство пользователя (вместе со счетчиком непрочитанных) читается по индексу (user_id, chat_id)
+    result = await db.execute(
+        select(
+            models.Chat, member_count, last_message_id,
+            models.ChatMember.unread_count, models.ChatMember.last_read_message_id
+        ).options(noload(models.Chat.members)).join(
+            models.ChatMember,
+            (models.ChatMember.chat_id == models.Chat.id) & (models.ChatMember.user_id == user_id)
+        ).order_by(models.Chat.id)
+    )
+    rows = result.all()
+
+    last_message_ids = [row[2] for row in rows if row[2] is not None]
+    last_messages = {}
+    if last_message_ids:
+        result = await db.execute(select(models.Message).filter(models.Message.id.in_(last_message_ids)))
+        last_messages = {message.chat_id: message for message in result.unique().scalars().all()}
+
+    private_chat_ids = [row[0].id for row in rows if not row[0].is_group_chat]
+    peers = {}
+    if private_chat_ids:
+        result = await db.execute(
+            select(models.ChatMember.chat_id, models.User.id, models.User.username).join(
+                models.User, models.User.id == models.ChatMember.user_id
+            ).filter(
+                models.ChatMember.chat_id.in_(private_chat_ids),
+                models.ChatMember.user_id != user_id
+            )
+        )
+        peers = {chat_id: schemas.ChatMemberUser(id=peer_id, username=username)
+                 for chat_id, peer_id, username in result.all()}
 
-def get_user_chats(db: Session, user_id: int):
-    """Получает все чаты, в которых состоит пользователь."""
-    return db.query(models.Chat).join(models.ChatMember).filter(models.ChatMember.user_id == user_id).all()
+    summaries = []
+    for chat, count, _, unread_count, last_read_message_id in rows:
+        last_message = last_messages.get(chat.id)
+        summaries.append(schemas.ChatSummary(
+            id=chat.id,
+            name=chat.name,
+            is_group_chat=chat.is_group_chat,
+            creator_id=chat.creator_id,
+            created_at=chat.created_at,
+            member_count=count,
+            last_message=schemas.MessageResponse(
+                id=last_message.id,
+                chat_id=last_message.chat_id,
+                sender_id=last_message.sender_id,
+                content=last_message.content,
+                timestamp=last_message.timestamp,
+                sender_username=last_message.sender.username if last_message.sender else None
+            ) if last_message else None,
+            peer=peers.get(chat.id),
+            unread_count=unread_count,
+            last_read_message_id=last_read_message_id
+        ))
+    return summaries
 
 
-def create_chat(db: Session, chat: schemas.ChatCreate, creator_id: int):
-    """Создает новый чат."""
+@track_db
+async def create_chat(db: AsyncSession, chat: schemas.ChatCreate, creator_id: int):
+    """
+    Создает новый чат вместе с участниками одной транзакцией: создатель и
+    initial_members_ids добавляются одним INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+    Несуществующие пользователи и повторы в списке пропускаются.
+    """
     db_chat = models.Chat(
         name=chat.name,
         is_group_chat=chat.is_group_chat,
         creator_id=creator_id if chat.is_group_chat else None
     )
     db.add(db_chat)
-    db.commit()
-    db.refresh(db_chat)
-
-    add_chat_member(db, chat_id=db_chat.id, user_id=creator_id)
+    await db.flush()
 
+    member_ids = {creator_id}
     if chat.is_group_chat and chat.initial_members_ids:
-        for member_id in chat.initial_members_ids:
-            if member_id != creator_id:
-                add_chat_member(db, chat_id=db_chat.id, user_id=member_id)
+        member_ids.update(chat.initial_members_ids)
+    await db.execute(
+        pg_insert(models.ChatMember).from_select(
+            ["chat_id", "user_id"],
+            select(literal(db_chat.id), models.User.id).filter(models.User.id.in_(member_ids))
+        ).on_conflict_do_nothing(index_elements=["chat_id", "user_id"])
+    )
+    await db.commit()
+    membership_cache.invalidate(db_chat.id)
 
+    # Перечитываем чат, чтобы в ответ попали только что добавленные участники
+    await db.refresh(db_chat)
     return db_chat
 
 
-def get_private_chat_between_users(db: Session, user1_id: int, user2_id: int):
-    """Находит личный чат между двумя пользователями."""
-    chat = db.query(models.Chat).filter(
-        models.Chat.is_group_chat == False
-    ).join(models.ChatMember).filter(
-        or_(
-            (models.ChatMember.user_id == user1_id),
-            (models.ChatMember.user_id == user2_id)
-        )
-    ).group_by(models.Chat.id).having(
-        func.count(models.ChatMember.user_id.distinct()) == 2
-    ).first()
-    return chat
+@track_db
+async def get_or_create_private_chat(db: AsyncSession, user_id: int, peer_id: int):
+    """
+    Возвращает личный чат двух пользователей, создавая его при необходимости.
+    Существующий чат находится чтением по ключу пары (уникальный индекс) без
+    записи; иначе INSERT ... ON CONFLICT DO NOTHING. Если параллельный запрос для
+    той же пары успел создать чат, вставка ничего не возвращает и чат читается
+    повторно. Возвращает (чат, создан ли он этим вызовом).
+    """
+    low, high = sorted((user_id, peer_id))
+    private_chat_id = select(models.Chat.id).filter(models.Chat.min_user_id == low, models.Chat.max_user_id == high)
+    chat_id = (await db.execute(private_chat_id)).scalar()
+    if chat_id is not None:
+        return await get_chat(db, chat_id), False
+
+    insert_stmt = sqlite_insert if db.get_bind().dialect.name == "sqlite" else pg_insert
+    chat_id = (await db.execute(
+        insert_stmt(models.Chat).values(
+            name=None, is_group_chat=False, creator_id=None, min_user_id=low, max_user_id=high
+        ).on_conflict_do_nothing(
+            index_elements=[models.Chat.min_user_id, models.Chat.max_user_id]
+        ).returning(models.Chat.id)
+    )).scalar()
+    if chat_id is None:
+        # Чат этой пары создан параллельным запросом (вставка дождалась его фиксации)
+        chat_id = (await db.execute(private_chat_id)).scalar_one()
+        return await get_chat(db, chat_id), False
 
+    await db.execute(insert(models.ChatMember), [
+        {"chat_id": chat_id, "user_id": low},
+        {"chat_id": chat_id, "user_id": high},
+    ])
+    await db.commit()
+    membership_cache.invalidate(chat_id)
+    return await get_chat(db, chat_id), True
 
-def add_chat_member(db: Session, chat_id: int, user_id: int):
+
+@track_db
+async def add_chat_member(db: AsyncSession, chat_id: int, user_id: int):
     """Добавляет пользователя в чат."""
-    existing_member = db.query(models.ChatMember).filter(
-        models.ChatMember.chat_id == chat_id,
-        models.ChatMember.user_id == user_id
-    ).first()
+    result = await db.execute(
+        select(models.ChatMember).filter(
+            models.ChatMember.chat_id == chat_id,
+            models.ChatMember.user_id == user_id
+        )
+    )
+    existing_member = result.unique().scalars().first()
     if existing_member:
         return existing_member
 
     db_chat_member = models.ChatMember(chat_id=chat_id, user_id=user_id)
     db.add(db_chat_member)
-    db.commit()
-    db.refresh(db_chat_member)
+    await db.commit()
+    membership_cache.invalidate(chat_id)
+    await db.refresh(db_chat_member)
     return db_chat_member
 
 
-def remove_chat_member(db: Session, chat_id: int, user_id: int):
+@track_db
+async def remove_chat_member(db: AsyncSession, chat_id: int, user_id: int):
     """Удаляет пользователя из чата."""
-    db_chat_member = db.query(models.ChatMember).filter(
-        models.ChatMember.chat_id == chat_id,
-        models.ChatMember.user_id == user_id
-    ).first()
+    result = await db.execute(
+        select(models.ChatMember).filter(
+            models.ChatMember.chat_id == chat_id,
+            models.ChatMember.user_id == user_id
+        )
+    )
+    db_chat_member = result.unique().scalars().first()
     if db_chat_member:
-        db.delete(db_chat_member)
-        db.commit()
+        await db.delete(db_chat_member)
+        await db.commit()
+        membership_cache.invalidate(chat_id)
         return True
     return False
 
 
-def create_message(db: Session, message: schemas.MessageCreate, chat_id: int, sender_id: int):
+@track_db
+async def create_message(db: AsyncSession, message: schemas.MessageCreate, chat_id: int, sender_id: int):
     """Создает новое сообщение в чате."""
     db_message = models.Message(
         chat_id=chat_id,
@@ -109,18 +252,308 @@ def create_message(db: Session, message: schemas.MessageCreate, chat_id: int, se
         content=message.content
     )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    # Непрочитанное у остальных участников растет в той же транзакции
+    await db.execute(
+        update(models.ChatMember).where(
+            models.ChatMember.chat_id == chat_id, models.ChatMember.user_id != sender_id
+        ).values(unread_count=models.ChatMember.unread_count + 1).execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    await db.refresh(db_message)
+    message_tail_cache.add(message_to_response(db_message))
     return db_message
 
 
-def get_chat_messages(db: Session, chat_id: int, skip: int = 0, limit: int = 100):
-    """Получает сообщения из конкретного чата."""
-    messages = db.query(models.Message).options(joinedload(models.Message.sender)).filter(
-        models.Message.chat_id == chat_id).order_by(models.Message.timestamp).all()
+@track_db
+async def create_messages_bulk(db: AsyncSession, messages: List[dict], sender_usernames: Optional[List[str]] = None):
+    """
+    Сохраняет пачку сообщений одним многострочным INSERT ... RETURNING и одной транзакцией.
+    Возвращает (id, timestamp) в порядке входного списка. Имена отправителей (в том же
+    порядке) нужны для кэша последних сообщений; без них затронутые чаты сбрасываются из кэша.
+    """
+    result = await db.execute(
+        insert(models.Message).returning(
+            models.Message.id, models.Message.timestamp, sort_by_parameter_order=True
+        ),
+        messages
+    )
+    rows = result.all()
+    await _increment_unread_counts(db, messages)
+    await db.commit()
+    for index, (message, (message_id, timestamp)) in enumerate(zip(messages, rows)):
+        if sender_usernames is None:
+            message_tail_cache.invalidate(message["chat_id"])
+            continue
+        message_tail_cache.add(schemas.MessageResponse(
+            id=message_id,
+            chat_id=message["chat_id"],
+            sender_id=message["sender_id"],
+            content=message["content"],
+            timestamp=timestamp,
+            sender_username=sender_usernames[index]
+        ))
+    return rows
+
+
+async def _increment_unread_counts(db: AsyncSession, messages: List[dict]):
+    """
+    Увеличивает счетчики непрочитанного для пачки сообщений двумя executemany:
+    всем участникам чата - на число сообщений пачки в чате, затем отправителям -
+    обратно на число их собственных сообщений. Чаты обходятся по возрастанию id,
+    чтобы параллельные транзакции блокировали строки в одном порядке.
+    """
+    chat_members = models.ChatMember.__table__
+    per_chat = Counter(message["chat_id"] for message in messages)
+    per_sender = Counter((message["chat_id"], message["sender_id"]) for message in messages)
+    await db.execute(
+        update(chat_members).where(chat_members.c.chat_id == bindparam("target_chat_id")).values(
+            unread_count=chat_members.c.unread_count + bindparam("increment")
+        ),
+        [{"target_chat_id": chat_id, "increment": count} for chat_id, count in sorted(per_chat.items())]
+    )
+    await db.execute(
+        update(chat_members).where(
+            chat_members.c.chat_id == bindparam("target_chat_id"),
+            chat_members.c.user_id == bindparam("target_user_id")
+        ).values(unread_count=chat_members.c.unread_count - bindparam("own_messages")),
+        [{"target_chat_id": chat_id, "target_user_id": sender_id, "own_messages": count}
+         for (chat_id, sender_id), count in sorted(per_sender.items())]
+    )
+
+
+def message_to_response(message: models.Message) -> schemas.MessageResponse:
+    """Сообщение с именем отправителя (sender загружается вместе с сообщением)."""
+    return schemas.MessageResponse(
+        id=message.id,
+        chat_id=message.chat_id,
+        sender_id=message.sender_id,
+        content=message.content,
+        timestamp=message.timestamp,
+        sender_username=message.sender.username if message.sender else f"User {message.sender_id}"
+    )
+
+
+async def get_latest_chat_messages(db: AsyncSession, chat_id: int, limit: int = 50) -> List[schemas.MessageResponse]:
+    """
+    Последняя страница сообщений чата. Обслуживается из кэша последних сообщений;
+    при промахе читается из БД сразу на весь размер хвоста кэша, чтобы следующие
+    запросы с любым limit в его пределах не обращались к БД.
+    """
+    cached = message_tail_cache.get_page(chat_id, limit)
+    if cached is not None:
+        return cached
+
+    fetch_limit = max(limit, settings.MESSAGE_CACHE_MESSAGES_PER_CHAT)
+    message_tail_cache.begin_fill(chat_id)
+    messages = None
+    try:
+        messages = [message_to_response(message)
+                    for message in await get_chat_messages(db, chat_id, limit=fetch_limit)]
+    finally:
+        message_tail_cache.end_fill(chat_id, messages, complete=messages is not None and len(messages) < fetch_limit)
+    return messages[-limit:]
+
+
+@track_db
+async def get_chat_messages(
+        db: AsyncSession,
+        chat_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = 50
+):
+    """
+    Получает страницу сообщений чата (keyset-пагинация по id).
+    Без курсоров возвращает последние `limit` сообщений; с `before_id` - более
+    старые, с `after_id` - более новые. Результат всегда упорядочен по возрастанию id.
+    Курсор дополнительно ограничивает timestamp (id и время растут вместе), чтобы
+    планировщик отбросил помесячные секции messages по другую сторону курсора.
+    """
+    query = select(models.Message).options(joinedload(models.Message.sender)).filter(
+        models.Message.chat_id == chat_id)
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+        cursor_timestamp = await _message_timestamp(db, chat_id, before_id)
+        if cursor_timestamp is not None:
+            query = query.filter(models.Message.timestamp <= cursor_timestamp + CURSOR_TIMESTAMP_SLACK)
+    if after_id is not None:
+        query = query.filter(models.Message.id > after_id)
+        cursor_timestamp = await _message_timestamp(db, chat_id, after_id)
+        if cursor_timestamp is not None:
+            query = query.filter(models.Message.timestamp >= cursor_timestamp - CURSOR_TIMESTAMP_SLACK)
+        query = query.order_by(models.Message.id.asc())
+    else:
+        query = query.order_by(models.Message.id.desc())
+
+    result = await db.execute(query.limit(limit))
+    messages = result.unique().scalars().all()
+    if after_id is None:
+        messages.reverse()
     return messages
 
 
-def get_chat_members(db: Session, chat_id: int):
-    """Получает всех участников чата."""
-    return db.query(models.User).join(models.ChatMember).filter(models.ChatMember.chat_id == chat_id).all()
\ No newline at end of file
+async def _message_timestamp(db: AsyncSession, chat_id: int, message_id: int) -> Optional[datetime]:
+    """Время сообщения-курсора (None, если его нет в чате) - одна проба индекса (chat_id, id)."""
+    result = await db.execute(
+        select(models.Message.timestamp).filter(models.Message.chat_id == chat_id, models.Message.id == message_id)
+    )
+    return result.scalar()
+
+
+async def stream_chat_messages(db: AsyncSession, chat_id: int, batch_size: int) -> AsyncIterator[Sequence[Row]]:
+    """
+    Вся история чата по возрастанию id пачками по batch_size строк через серверный
+    курсор: в памяти одновременно не больше одной пачки, ORM-объекты не создаются.
+    Строки: id, chat_id, sender_id, sender_username, content, timestamp.
+    (Без track_db: время генератора - это время потребителя, а не запроса.)
+    """
+    result = await db.stream(
+        select(
+            models.Message.id,
+            models.Message.chat_id,
+            models.Message.sender_id,
+            models.User.username.label("sender_username"),
+            models.Message.content,
+            models.Message.timestamp,
+        ).join(models.User, models.User.id == models.Message.sender_id).filter(
+            models.Message.chat_id == chat_id
+        ).order_by(models.Message.id).execution_options(yield_per=batch_size)
+    )
+    async for partition in result.partitions():
+        yield partition
+
+
+@track_db
+async def search_messages(
+        db: AsyncSession,
+        query: str,
+        user_id: int,
+        chat_id: Optional[int] = None,
+        after_rank: Optional[float] = None,
+        after_id: Optional[int] = None,
+        limit: int = 20
+) -> List[schemas.MessageSearchResult]:
+    """
+    Полнотекстовый поиск по GIN-индексу search_vector. Запрос в синтаксисе веб-поиска
+    (слова, "фразы", -исключения). Ищет в одном чате или во всех чатах пользователя.
+    Результаты упорядочены по (rank, id) по убыванию; следующая страница - с курсором
+    (after_rank, after_id) последнего результата.
+    """
+    ts_query = func.websearch_to_tsquery(literal_column(f"'{models.SEARCH_TEXT_CONFIG}'::regconfig"), query)
+    rank = func.ts_rank(models.Message.search_vector, ts_query)
+    stmt = select(models.Message, rank).options(joinedload(models.Message.sender)).filter(
+        models.Message.search_vector.op("@@")(ts_query)
+    )
+    if chat_id is not None:
+        stmt = stmt.filter(models.Message.chat_id == chat_id)
+    else:
+        stmt = stmt.filter(models.Message.chat_id.in_(
+            select(models.ChatMember.chat_id).filter(models.ChatMember.user_id == user_id)
+        ))
+    if after_rank is not None and after_id is not None:
+        stmt = stmt.filter(tuple_(rank, models.Message.id) < tuple_(after_rank, after_id))
+
+    result = await db.execute(stmt.order_by(rank.desc(), models.Message.id.desc()).limit(limit))
+    return [
+        schemas.MessageSearchResult(**message_to_response(message).model_dump(), rank=message_rank)
+        for message, message_rank in result.unique().all()
+    ]
+
+
+@track_db
+async def mark_chat_read(
+        db: AsyncSession, chat_id: int, user_id: int, message_id: Optional[int] = None
+) -> Optional[Tuple[schemas.ChatReadState, bool]]:
+    """
+    Отмечает сообщения чата прочитанными до message_id (без него - до последнего).
+    Граница сдвигается только вперед и только до существующего сообщения чата;
+    счетчик пересчитывается по индексу (chat_id, id) для сообщений новее границы.
+    Строка участника блокируется до подсчета: параллельная запись сообщения либо
+    уже зафиксирована (и попадет в подсчет), либо ждет блокировку и увеличит
+    счетчик после пересчета - инкремент не теряется.
+    Возвращает (состояние прочтения, сдвинулась ли граница) или None, если
+    пользователь не участник чата (кэш членства мог устареть).
+    """
+    result = await db.execute(
+        select(models.ChatMember.last_read_message_id, models.ChatMember.unread_count).filter(
+            models.ChatMember.chat_id == chat_id, models.ChatMember.user_id == user_id
+        ).with_for_update()
+    )
+    row = result.first()
+    if row is None:
+        await db.rollback()
+        return None
+    last_read_message_id, unread_count = row
+
+    target = select(func.max(models.Message.id)).filter(models.Message.chat_id == chat_id)
+    if message_id is not None:
+        target = target.filter(models.Message.id <= message_id)
+    target_id = (await db.execute(target)).scalar()
+    if target_id is None or (last_read_message_id is not None and last_read_message_id >= target_id):
+        await db.commit()
+        return schemas.ChatReadState(
+            chat_id=chat_id, last_read_message_id=last_read_message_id, unread_count=unread_count
+        ), False
+
+    unread_count = (await db.execute(
+        select(func.count(models.Message.id)).filter(
+            models.Message.chat_id == chat_id,
+            models.Message.id > target_id,
+            models.Message.sender_id != user_id
+        )
+    )).scalar_one()
+    await db.execute(
+        update(models.ChatMember).where(
+            models.ChatMember.chat_id == chat_id, models.ChatMember.user_id == user_id
+        ).values(last_read_message_id=target_id, unread_count=unread_count)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return schemas.ChatReadState(chat_id=chat_id, last_read_message_id=target_id, unread_count=unread_count), True
+
+
+@track_db
+async def get_unread_counts(db: AsyncSession, user_id: int) -> List[schemas.ChatReadState]:
+    """Счетчики непрочитанного по всем чатам пользователя - одно чтение по индексу (user_id, chat_id)."""
+    result = await db.execute(
+        select(models.ChatMember.chat_id, models.ChatMember.last_read_message_id, models.ChatMember.unread_count)
+        .filter(models.ChatMember.user_id == user_id).order_by(models.ChatMember.chat_id)
+    )
+    return [
+        schemas.ChatReadState(chat_id=chat_id, last_read_message_id=last_read_message_id, unread_count=unread_count)
+        for chat_id, last_read_message_id, unread_count in result.all()
+    ]
+
+
+async def get_chat_member_ids(db: AsyncSession, chat_id: int) -> Optional[frozenset]:
+    """
+    Возвращает множество ID участников чата или None, если чат не найден.
+    Результат кэшируется; add_chat_member и remove_chat_member сбрасывают запись чата.
+    """
+    member_ids = membership_cache.get(chat_id)
+    if member_ids is not None:
+        return member_ids
+    return await _load_chat_member_ids(db, chat_id)
+
+
+@track_db
+async def _load_chat_member_ids(db: AsyncSession, chat_id: int) -> Optional[frozenset]:
+    result = await db.execute(
+        select(models.Chat.id, models.ChatMember.user_id).outerjoin(
+            models.ChatMember, models.ChatMember.chat_id == models.Chat.id
+        ).filter(models.Chat.id == chat_id)
+    )
+    rows = result.all()
+    if not rows:
+        return None
+    member_ids = frozenset(user_id for _, user_id in rows if user_id is not None)
+    membership_cache.set(chat_id, member_ids)
+    return member_ids
+
+
+async def is_chat_member(db: AsyncSession, chat_id: int, user_id: int) -> Optional[bool]:
+    """Проверяет членство пользователя в чате через кэш. None - чат не найден."""
+    member_ids = await get_chat_member_ids(db, chat_id)
+    if member_ids is None:
+        return None
+    return user_id in member_ids
@@ -1,11 +1,29 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from app.auth.router import router as auth_router
 from app.api.endpoints.chats import router as chats_router
 from app.api.websockets.chat import router as websockets_router
+from app.api.websockets.ws_manager import manager
+from app.config import settings
+from app.message_writer import message_writer
+from app.metrics import HTTPMetricsMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await manager.start()
+    if settings.MESSAGE_WRITE_BEHIND:
+        message_writer.start()
+    yield
+    await message_writer.stop()
+    await manager.stop()
 
-app = FastAPI(title="Simple Chat Service")
+
+app = FastAPI(title="Simple Chat Service", lifespan=lifespan)
 
 # ----- Настройки CORS -----
 origins = [
@@ -21,6 +39,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(HTTPMetricsMiddleware)
 # --------------------------
 
 app.include_router(auth_router, prefix="/auth", tags=["Auth"])
@@ -29,4 +48,9 @@ app.include_router(websockets_router, tags=["WebSockets"])
 
 @app.get("/")
 async def root():
-    return {"message": "Welcome to Simple Chat Service API!"}
\ No newline at end of file
+    return {"message": "Welcome to Simple Chat Service API!"}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики воркера в текстовом формате Prometheus."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
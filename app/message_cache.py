@@ -0,0 +1,164 @@
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from app import schemas
+from app.config import settings
+
+# Приблизительные накладные расходы на одно сообщение в кэше (объект схемы, datetime, строки)
+MESSAGE_OVERHEAD_BYTES = 400
+
+
+def _message_size(message: schemas.MessageResponse) -> int:
+    return MESSAGE_OVERHEAD_BYTES + len(message.content) + len(message.sender_username or "")
+
+
+class _ChatTail:
+    __slots__ = ("messages", "ids", "complete", "size", "expires_at")
+
+    def __init__(self, messages: List[schemas.MessageResponse], complete: bool, expires_at: float):
+        self.messages = messages
+        # id сообщений в том же порядке - для bisect без пересборки списка
+        self.ids = [message.id for message in messages]
+        # True - в кэше вся история чата, а не только последние сообщения
+        self.complete = complete
+        self.size = sum(_message_size(message) for message in messages)
+        self.expires_at = expires_at
+
+
+class MessageTailCache:
+    """
+    Последние сообщения активных чатов в памяти воркера. Хвост чата - непрерывный:
+    в нем все сообщения новее самого старого закэшированного. Заполняется при
+    чтении последней страницы и дополняется каждым новым сообщением: записанным в
+    этом воркере (crud) и пришедшим через бэкплейн от других. Тот же хвост служит буфером досылки при переподключении
+    (since). ttl страхует от событий бэкплейна, потерянных при обрыве. Объем
+    ограничен числом сообщений на чат и общим бюджетом памяти; при превышении
+    вытесняются давно не использовавшиеся чаты.
+    """
+    def __init__(self, messages_per_chat: int, max_bytes: int, ttl: float):
+        self.messages_per_chat = messages_per_chat
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._tails: "OrderedDict[int, _ChatTail]" = OrderedDict()
+        # chat_id -> [число незавершенных чтений из БД, была ли запись во время чтения]
+        self._fills: Dict[int, list] = {}
+
+    def get_page(self, chat_id: int, limit: int) -> Optional[List[schemas.MessageResponse]]:
+        """Последние `limit` сообщений чата или None, если хвост не закэширован или короче `limit`."""
+        tail = self._tails.get(chat_id)
+        if tail is None:
+            return None
+        if tail.expires_at <= time.monotonic():
+            self._drop(chat_id)
+            return None
+        if len(tail.messages) < limit and not tail.complete:
+            return None
+        self._tails.move_to_end(chat_id)
+        return tail.messages[-limit:]
+
+    def since(self, chat_id: int, last_message_id: int) -> Optional[List[schemas.MessageResponse]]:
+        """
+        Сообщения чата с id > last_message_id по возрастанию id или None, если хвост
+        не покрывает разрыв (самое старое сообщение хвоста новее last_message_id).
+        """
+        tail = self._tails.get(chat_id)
+        if tail is None:
+            return None
+        if tail.expires_at <= time.monotonic():
+            self._drop(chat_id)
+            return None
+        if not tail.complete and (not tail.messages or tail.messages[0].id > last_message_id):
+            return None
+        return tail.messages[bisect_right(tail.ids, last_message_id):]
+
+    def begin_fill(self, chat_id: int):
+        """Отмечает начало чтения хвоста из БД (до запроса)."""
+        fill = self._fills.setdefault(chat_id, [0, False])
+        fill[0] += 1
+
+    def end_fill(self, chat_id: int, messages: Optional[List[schemas.MessageResponse]], complete: bool = False):
+        """
+        Кэширует прочитанный хвост (по возрастанию id). Если во время чтения в чат
+        писали, результат мог не увидеть новое сообщение, и он не кэшируется.
+        messages=None - чтение не удалось.
+        """
+        fill = self._fills[chat_id]
+        fill[0] -= 1
+        written = fill[1]
+        if fill[0] == 0:
+            del self._fills[chat_id]
+        if messages is None or written:
+            return
+        self._drop(chat_id)
+        if len(messages) > self.messages_per_chat:
+            messages, complete = messages[-self.messages_per_chat:], False
+        tail = _ChatTail(list(messages), complete, time.monotonic() + self.ttl)
+        self._tails[chat_id] = tail
+        self.total_bytes += tail.size
+        self._enforce_budget()
+
+    def add(self, message: schemas.MessageResponse):
+        """
+        Добавляет новое сообщение. Для незакэшированного чата начинается хвост из
+        одного сообщения: все следующие сообщения чата тоже пройдут через add.
+        """
+        fill = self._fills.get(message.chat_id)
+        if fill is not None:
+            fill[1] = True
+        tail = self._tails.get(message.chat_id)
+        if tail is None:
+            tail = _ChatTail([message], False, time.monotonic() + self.ttl)
+            self._tails[message.chat_id] = tail
+            self.total_bytes += tail.size
+            self._enforce_budget()
+            return
+        ids = tail.ids
+        # Параллельные записи могут завершиться не в порядке id
+        position = bisect_left(ids, message.id)
+        if position < len(ids) and ids[position] == message.id:
+            return
+        tail.messages.insert(position, message)
+        ids.insert(position, message.id)
+        size = _message_size(message)
+        tail.size += size
+        self.total_bytes += size
+        while len(tail.messages) > self.messages_per_chat:
+            evicted = tail.messages.pop(0)
+            ids.pop(0)
+            tail.complete = False
+            evicted_size = _message_size(evicted)
+            tail.size -= evicted_size
+            self.total_bytes -= evicted_size
+        self._tails.move_to_end(message.chat_id)
+        self._enforce_budget()
+
+    def invalidate(self, chat_id: int):
+        """Сбрасывает хвост чата (например, после записи без данных для кэша)."""
+        fill = self._fills.get(chat_id)
+        if fill is not None:
+            fill[1] = True
+        self._drop(chat_id)
+
+    def clear(self):
+        self._tails.clear()
+        self.total_bytes = 0
+
+    def _drop(self, chat_id: int):
+        tail = self._tails.pop(chat_id, None)
+        if tail is not None:
+            self.total_bytes -= tail.size
+
+    def _enforce_budget(self):
+        while self.total_bytes > self.max_bytes and self._tails:
+            _, tail = self._tails.popitem(last=False)
+            self.total_bytes -= tail.size
+
+
+message_tail_cache = MessageTailCache(
+    messages_per_chat=settings.MESSAGE_CACHE_MESSAGES_PER_CHAT,
+    max_bytes=settings.MESSAGE_CACHE_MAX_BYTES,
+    ttl=settings.MESSAGE_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from app import crud
+from app.config import settings
+from app.database import AsyncSessionLocal
+
+
+class MessageBatchWriter:
+    """
+    Пакетная запись сообщений. Сообщения со всех сокетов копятся несколько
+    миллисекунд и сохраняются одной транзакцией; каждый отправитель получает
+    id и timestamp своего сообщения, когда пакет уже записан в БД. Если пакет
+    не записался, сообщения пишутся по одному: ошибка достается только
+    отправителю сообщения, которое ее вызвало.
+    """
+    def __init__(self, flush_interval: float, max_batch_size: int):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописывает накопленные сообщения и останавливает запись."""
+        if self._task is None:
+            return
+        self.queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, chat_id: int, sender_id: int, content: str, sender_username: str) -> Tuple[int, datetime]:
+        """Ставит сообщение в пакет и ждет, пока пакет будет сохранен."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(({"chat_id": chat_id, "sender_id": sender_id, "content": content},
+                               sender_username, future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            if self.queue.empty():
+                # Под нагрузкой пакет набирается, пока пишется предыдущий; ждем только в тишине
+                await asyncio.sleep(self.flush_interval)
+
+            batch = [item]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[tuple]):
+        try:
+            rows = await self._write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                print(f"Failed to persist message: {e}")
+                _, _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            print(f"Failed to persist batch of {len(batch)} messages, retrying one by one: {e}")
+            for item in batch:
+                await self._flush([item])
+            return
+
+        for (_, _, future), (message_id, timestamp) in zip(batch, rows):
+            if not future.done():
+                future.set_result((message_id, timestamp))
+
+    async def _write(self, batch: List[tuple]):
+        async with AsyncSessionLocal() as db:
+            return await crud.create_messages_bulk(
+                db, [message for message, _, _ in batch], [username for _, username, _ in batch]
+            )
+
+
+message_writer = MessageBatchWriter(
+    flush_interval=settings.MESSAGE_BATCH_FLUSH_INTERVAL_MS / 1000,
+    max_batch_size=settings.MESSAGE_BATCH_MAX_SIZE,
+)
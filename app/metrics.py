@@ -0,0 +1,70 @@
+import functools
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Метрики собираются в памяти процесса: каждый воркер отдает на /metrics свои значения.
+
+WS_ACTIVE_CONNECTIONS = Gauge("ws_active_connections", "Active WebSocket connections in this worker")
+WS_MESSAGES_IN = Counter("ws_messages_in_total", "Chat messages received over WebSocket")
+# type - тип кадра ("message" - сообщения чатов; "ping", "replay", "read", ...; "error" - кадры ошибок)
+WS_FRAMES_OUT = Counter("ws_frames_out_total", "Frames sent to WebSocket clients", ["type"])
+WS_DROPPED_FRAMES = Counter(
+    "ws_dropped_frames_total", "Frames dropped from full outbound queues (drop_oldest policy)"
+)
+WS_EVICTIONS = Counter("ws_evictions_total", "WebSocket connections closed by the server", ["reason"])
+WS_BROADCAST_SECONDS = Histogram(
+    "ws_broadcast_fanout_seconds", "Time to fan a broadcast out to local queues and the backplane",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+MESSAGE_PERSIST_SECONDS = Histogram(
+    "message_receive_to_persist_seconds", "Time from receiving a chat message to having it stored",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Duration of crud functions", ["function"])
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_seconds", "bcrypt time spent in the worker pool", ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2)
+)
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+
+
+def track_db(func):
+    """
+    Декоратор для async-функций crud, которые обращаются к БД: время выполнения в
+    db_query_seconds{function=...}. Метка - имя функции без ведущего подчеркивания
+    (например, create_user замеряет только вставку через _insert_user, без bcrypt).
+    """
+    histogram = DB_QUERY_SECONDS.labels(func.__name__.lstrip("_"))
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+class HTTPMetricsMiddleware:
+    """
+    ASGI-middleware для задержки HTTP-запросов по шаблону маршрута
+    (например, /api/chats/{chat_id}/messages), чтобы не плодить метки по ID.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], route.path if route is not None else "unmatched"
+            ).observe(time.perf_counter() - start)
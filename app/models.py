@@ -1,8 +1,14 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import (
+    Column, Integer, String, DateTime, ForeignKey, Boolean, Text, Index, FetchedValue, UniqueConstraint
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import func
 from app.database import Base
 
+# Конфигурация полнотекстового поиска: без стемминга, одинаково для любых языков
+SEARCH_TEXT_CONFIG = "simple"
+
 
 class User(Base):
     __tablename__ = "users"
@@ -22,9 +28,18 @@ class Chat(Base):
     is_group_chat = Column(Boolean, default=False, nullable=False)
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Личный чат: ID двух участников по возрастанию (у групп - NULL).
+    # Уникальный индекс по паре исключает дубликаты и дает поиск чата за один индексный запрос
+    min_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    max_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
 
     members = relationship("ChatMember", back_populates="chat", lazy="joined")
-    messages = relationship("Message", back_populates="chat_relation", lazy="selectin")
+    # История чата загружается только явно (selectinload) или постранично через crud.get_chat_messages
+    messages = relationship("Message", back_populates="chat_relation", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_chats_private_pair", "min_user_id", "max_user_id", unique=True),
+    )
 
 
 class ChatMember(Base):
@@ -34,10 +49,22 @@ class ChatMember(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Состояние прочтения: id последнего прочитанного сообщения (без внешнего ключа -
+    # ключ секционированной messages составной) и число непрочитанных чужих сообщений,
+    # которое увеличивается при записи сообщений и сбрасывается при mark_read
+    last_read_message_id = Column(Integer, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     user = relationship("User", back_populates="chat_memberships", lazy="joined")
     chat = relationship("Chat", back_populates="members")
 
+    __table_args__ = (
+        # Список чатов пользователя: WHERE user_id = ?
+        Index("ix_chat_members_user_id_chat_id", "user_id", "chat_id"),
+        # Пользователь состоит в чате не более одного раза; цель ON CONFLICT при массовом добавлении
+        UniqueConstraint("chat_id", "user_id", name="uq_chat_members_chat_id_user_id"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -46,7 +73,21 @@ class Message(Base):
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Ключ секционирования таблицы (помесячные секции, см. app/partitions.py);
+    # первичный ключ в базе - (id, timestamp)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # В Postgres - генерируемый столбец to_tsvector(SEARCH_TEXT_CONFIG, content), см. миграцию
+    # c4e8a1f5d2b7; заполняется базой и в обычные запросы не загружается
+    search_vector = deferred(Column(TSVECTOR().with_variant(Text(), "sqlite"), server_default=FetchedValue()))
 
     chat_relation = relationship("Chat", back_populates="messages")
-    sender = relationship("User", back_populates="messages", lazy="joined")
\ No newline at end of file
+    sender = relationship("User", back_populates="messages", lazy="joined")
+
+    __table_args__ = (
+        # Keyset-пагинация истории: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # Полнотекстовый поиск: search_vector @@ websearch_to_tsquery(...)
+        Index("ix_messages_search_vector", "search_vector", postgresql_using="gin"),
+    )
+    # Не возвращать search_vector через RETURNING при каждой вставке
+    __mapper_args__ = {"eager_defaults": False}
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Обслуживание помесячных секций таблицы messages (секционирование по timestamp,
+см. миграцию f7b4d0e2a9c5).
+
+    python -m app.partitions create [--months-ahead N]
+        создает секции на N месяцев вперед (запускать по расписанию, например раз в сутки);
+    python -m app.partitions archive [--retention-months N] [--archive-dir DIR]
+        выгружает секции старше N месяцев в DIR/messages_YYYY_MM.csv.gz и удаляет их из базы.
+"""
+import argparse
+import gzip
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from app.config import settings
+from app.database import engine
+
+PARENT_TABLE = "messages"
+DEFAULT_PARTITION = "messages_default"
+# Столбцы выгрузки (search_vector генерируется и в архив не попадает)
+ARCHIVE_COLUMNS = 'id, chat_id, sender_id, content, "timestamp"'
+
+_BOUND_RE = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+_SHORT_OFFSET_RE = re.compile(r"[+-]\d\d$")
+
+
+@dataclass
+class Partition:
+    name: str
+    lower: Optional[datetime]  # None - секция по умолчанию
+    upper: Optional[datetime]
+
+
+def month_start(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARENT_TABLE}_{month:%Y_%m}"
+
+
+def _parse_bound(value: str) -> datetime:
+    # Postgres выводит смещение как "+03", fromisoformat до Python 3.11 ждет "+03:00"
+    if _SHORT_OFFSET_RE.search(value):
+        value += ":00"
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
+def list_partitions(conn: Connection) -> List[Partition]:
+    """Секции таблицы messages с границами, по возрастанию нижней границы."""
+    rows = conn.execute(text("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :parent
+    """), {"parent": PARENT_TABLE}).all()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound)
+        if match is None:
+            partitions.append(Partition(name, None, None))
+            continue
+        lower, upper = (_parse_bound(value) for value in match.groups())
+        partitions.append(Partition(name, lower, upper))
+    return sorted(partitions, key=lambda partition: partition.lower or datetime.min.replace(tzinfo=timezone.utc))
+
+
+def create_partition(conn: Connection, month: datetime) -> str:
+    """
+    Создает секцию месяца. Строки этого месяца, уже попавшие в секцию по умолчанию
+    (секцию не создали вовремя), переносятся в новую секцию той же транзакцией.
+    """
+    name = partition_name(month)
+    bounds = {"lower": month, "upper": add_months(month, 1)}
+    in_range = '"timestamp" >= :lower AND "timestamp" < :upper'
+
+    conn.execute(text(
+        f"CREATE TEMPORARY TABLE stray_messages ON COMMIT DROP AS "
+        f"SELECT {ARCHIVE_COLUMNS} FROM {DEFAULT_PARTITION} WHERE {in_range}"
+    ), bounds)
+    conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}"), bounds)
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+        f"FOR VALUES FROM ('{bounds['lower'].isoformat()}') TO ('{bounds['upper'].isoformat()}')"
+    ))
+    conn.execute(text(f"INSERT INTO {PARENT_TABLE} ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM stray_messages"))
+    return name
+
+
+def create_future_partitions(months_ahead: int) -> List[str]:
+    """Создает недостающие секции от текущего месяца до months_ahead месяцев вперед."""
+    created = []
+    now = month_start(datetime.now(timezone.utc))
+    for offset in range(months_ahead + 1):
+        month = add_months(now, offset)
+        # Каждая секция - отдельной транзакцией: DDL берет блокировку на родительскую таблицу
+        with engine.begin() as conn:
+            existing = {partition.name for partition in list_partitions(conn)}
+            if partition_name(month) not in existing:
+                created.append(create_partition(conn, month))
+    return created
+
+
+def archive_partition(partition: Partition, archive_dir: str) -> str:
+    """
+    Выгружает секцию в gzip-сжатый CSV и удаляет ее. Файл пишется во временный,
+    сбрасывается на диск и переименовывается до удаления секции: при сбое данные
+    остаются в базе.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{partition.name}.csv.gz")
+    tmp_path = path + ".tmp"
+
+    raw_connection = engine.raw_connection()
+    try:
+        with gzip.open(tmp_path, "wb") as archive, raw_connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY (SELECT {ARCHIVE_COLUMNS} FROM {partition.name} ORDER BY id) "
+                f"TO STDOUT WITH (FORMAT csv, HEADER)",
+                archive
+            )
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+    with open(tmp_path, "rb") as archive:
+        os.fsync(archive.fileno())
+    os.replace(tmp_path, path)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {partition.name}"))
+        conn.execute(text(f"DROP TABLE {partition.name}"))
+    return path
+
+
+def archive_old_partitions(retention_months: int, archive_dir: str) -> List[str]:
+    """Архивирует секции, целиком лежащие раньше, чем retention_months месяцев назад."""
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -retention_months)
+    with engine.connect() as conn:
+        partitions = list_partitions(conn)
+    return [
+        archive_partition(partition, archive_dir)
+        for partition in partitions
+        if partition.upper is not None and partition.upper <= cutoff
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance of the partitioned messages table")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="Create partitions ahead of time")
+    create.add_argument("--months-ahead", type=int, default=settings.MESSAGE_PARTITION_MONTHS_AHEAD)
+    archive = commands.add_parser("archive", help="Dump old partitions to compressed files and drop them")
+    archive.add_argument("--retention-months", type=int, default=settings.MESSAGE_RETENTION_MONTHS)
+    archive.add_argument("--archive-dir", default=settings.MESSAGE_ARCHIVE_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        created = create_future_partitions(args.months_ahead)
+        print(f"Created partitions: {', '.join(created) or 'none'}")
+    else:
+        archived = archive_old_partitions(args.retention_months, args.archive_dir)
+        print(f"Archived partitions: {', '.join(archived) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket: `rate` токенов в секунду, не более `capacity` в запасе.
+    Каждое разрешенное действие тратит один токен.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, amount: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount: float = 1) -> float:
+        """Через сколько секунд накопится `amount` токенов."""
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
@@ -80,6 +80,10 @@ class MessageResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class MessageSearchResult(MessageResponse):
+    """Найденное сообщение; rank и id последнего результата - курсор следующей страницы."""
+    rank: float
+
 class ChatBase(BaseModel):
     name: Optional[str] = None
     is_group_chat: bool = False
@@ -92,8 +96,24 @@ class Chat(ChatBase):
     id: int
     creator_id: Optional[int] = None
     created_at: datetime
-    messages: List[Message] = []
     members: List[ChatMember] = []
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class ChatSummary(ChatBase):
+    """Краткая информация о чате для списка чатов (без участников и истории)."""
+    id: int
+    creator_id: Optional[int] = None
+    created_at: datetime
+    member_count: int
+    last_message: Optional[MessageResponse] = None
+    peer: Optional[ChatMemberUser] = None # Собеседник в личном чате
+    unread_count: int = 0
+    last_read_message_id: Optional[int] = None
+
+class ChatReadState(BaseModel):
+    """Состояние прочтения чата текущим пользователем."""
+    chat_id: int
+    last_read_message_id: Optional[int] = None
+    unread_count: int
\ No newline at end of file
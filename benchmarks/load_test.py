@@ -0,0 +1,528 @@
+"""
+Нагрузочный тест чат-сервера.
+
+Поднимает uvicorn с app.main:app (или использует уже запущенный сервер через
+--server-url), наполняет базу синтетическими пользователями, чатами разного
+размера и историей сообщений, после чего измеряет:
+
+  * скорость установки WebSocket-соединений (/ws);
+  * пропускную способность и задержку доставки сообщений (p50/p99);
+  * пропускную способность /auth/token;
+  * задержку GET /api/chats/{id}/messages на историях разного размера.
+
+Результаты печатаются и сохраняются в JSON (--output). С --baseline результаты
+сравниваются с предыдущим прогоном, и при регрессии больше --max-regression
+процесс завершается с кодом 1.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.load_test --database-url sqlite:///./bench.db --clients 2000
+    python -m benchmarks.load_test --output bench.json --baseline baseline.json
+
+Без --database-url используются DB_* из окружения / .env (Postgres со схемой,
+накатанной `alembic upgrade head`). Для SQLite схема создается автоматически.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+BENCH_PASSWORD = "bench-password"
+BENCH_CONTENT_PREFIX = "bench:"
+SEED_BATCH_SIZE = 5000
+# Сколько ждать подтверждения всех подписок клиента
+SUBSCRIBE_TIMEOUT_SECONDS = 60
+
+# Метрики, по которым сравнивается с baseline: путь в отчете -> True, если больше - лучше
+GATED_METRICS = {
+    ("connect", "per_second"): True,
+    ("messages", "delivered_per_second"): True,
+    ("messages", "p99_ms"): False,
+    ("login", "per_second"): True,
+}
+GATED_HISTORY_METRICS = {"latest_p99_ms": False, "deep_p99_ms": False}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test for the chat server")
+    parser.add_argument("--database-url", help="Override DATABASE_URL, e.g. sqlite:///./bench.db")
+    parser.add_argument("--server-url", help="Use an already running server instead of booting uvicorn")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (set BROADCAST_BACKPLANE for >1)")
+    parser.add_argument("--server-log", default=os.devnull, help="File for the booted server output")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for chat layout and traffic")
+
+    parser.add_argument("--clients", type=int, default=2000, help="Number of synthetic WebSocket clients")
+    parser.add_argument("--chat-sizes", default="2,2,2,10,10,50,200",
+                        help="Comma-separated chat sizes, cycled until every client is in a chat")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--send-rate", type=float, default=0.5, help="Messages per second per client")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds of traffic before measuring")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of measured traffic")
+
+    parser.add_argument("--login-concurrency", type=int, default=16)
+    parser.add_argument("--login-duration", type=float, default=10.0)
+
+    parser.add_argument("--history-sizes", default="100,10000,100000",
+                        help="Comma-separated history sizes for GET /api/chats/{id}/messages")
+    parser.add_argument("--history-requests", type=int, default=100, help="Requests per history size and page")
+
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.15,
+                        help="Allowed relative regression of gated metrics (0.15 = 15%%)")
+    return parser.parse_args(argv)
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(seconds: List[float]) -> dict:
+    p50, p99 = percentile(seconds, 50), percentile(seconds, 99)
+    return {
+        "p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+    }
+
+
+def raise_open_files_limit():
+    """Тысячи сокетов в одном процессе упираются в RLIMIT_NOFILE."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ----- Подготовка данных -----
+
+@dataclass
+class Dataset:
+    run_id: str
+    users: List[dict]  # {"id", "username", "token"}
+    chats_by_user: Dict[int, List[int]]
+    chat_count: int
+    history_chats: Dict[int, dict]  # размер истории -> {"chat_id", "min_id", "max_id"}
+
+
+def prepare_schema():
+    from app.config import settings
+    from app.database import Base, engine
+    from sqlalchemy.engine import make_url
+
+    # Для Postgres схема накатывается миграциями; SQLite-заглушка создается с нуля.
+    if make_url(settings.DATABASE_URL).get_backend_name() == "sqlite":
+        from app import models  # noqa: F401 - регистрирует таблицы в Base.metadata
+        Base.metadata.create_all(engine)
+
+
+def _insert_returning_ids(conn, model, rows: List[dict]) -> List[int]:
+    from sqlalchemy import insert
+
+    ids = []
+    for start in range(0, len(rows), SEED_BATCH_SIZE):
+        batch = rows[start:start + SEED_BATCH_SIZE]
+        result = conn.execute(insert(model).returning(model.id, sort_by_parameter_order=True), batch)
+        ids.extend(result.scalars().all())
+    return ids
+
+
+def seed_dataset(args: argparse.Namespace, rng: random.Random) -> Dataset:
+    """Наполняет базу напрямую (минуя bcrypt на каждого пользователя) и выпускает токены."""
+    from sqlalchemy import func, insert, select
+
+    from app import models
+    from app.auth.security import create_access_token, get_password_hash
+    from app.database import engine
+
+    run_id = uuid.uuid4().hex[:8]
+    hashed_password = get_password_hash(BENCH_PASSWORD)
+    chat_sizes = [int(size) for size in args.chat_sizes.split(",")]
+    history_sizes = [int(size) for size in args.history_sizes.split(",")]
+
+    with engine.begin() as conn:
+        usernames = [f"bench_{run_id}_{i}" for i in range(args.clients)]
+        user_ids = _insert_returning_ids(conn, models.User, [
+            {"username": username, "hashed_password": hashed_password} for username in usernames
+        ])
+
+        # Чаты разных размеров, пока каждый клиент не окажется хотя бы в одном
+        unassigned = list(user_ids)
+        rng.shuffle(unassigned)
+        layouts = []
+        while unassigned:
+            size = min(chat_sizes[len(layouts) % len(chat_sizes)], len(user_ids))
+            members = unassigned[:size]
+            unassigned = unassigned[size:]
+            if len(members) < size:
+                taken = set(members)
+                others = [user_id for user_id in user_ids if user_id not in taken]
+                members += rng.sample(others, size - len(members))
+            layouts.append(members)
+
+        chat_ids = _insert_returning_ids(conn, models.Chat, [
+            {"name": f"bench_{run_id}_{i}", "is_group_chat": len(members) > 2, "creator_id": members[0]}
+            for i, members in enumerate(layouts)
+        ])
+        chats_by_user: Dict[int, List[int]] = {user_id: [] for user_id in user_ids}
+        member_rows = []
+        for chat_id, members in zip(chat_ids, layouts):
+            for user_id in members:
+                chats_by_user[user_id].append(chat_id)
+                member_rows.append({"chat_id": chat_id, "user_id": user_id})
+        for start in range(0, len(member_rows), SEED_BATCH_SIZE):
+            conn.execute(insert(models.ChatMember), member_rows[start:start + SEED_BATCH_SIZE])
+
+        # Отдельный чат с историей заданного размера для каждого замера пагинации
+        reader_id = user_ids[0]
+        history_chats = {}
+        for size in history_sizes:
+            [chat_id] = _insert_returning_ids(conn, models.Chat, [
+                {"name": f"bench_{run_id}_history_{size}", "is_group_chat": True, "creator_id": reader_id}
+            ])
+            conn.execute(insert(models.ChatMember), [{"chat_id": chat_id, "user_id": reader_id}])
+            for start in range(0, size, SEED_BATCH_SIZE):
+                conn.execute(insert(models.Message), [
+                    {"chat_id": chat_id, "sender_id": reader_id, "content": f"history message {i}"}
+                    for i in range(start, min(size, start + SEED_BATCH_SIZE))
+                ])
+            min_id, max_id = conn.execute(
+                select(func.min(models.Message.id), func.max(models.Message.id))
+                .where(models.Message.chat_id == chat_id)
+            ).one()
+            history_chats[size] = {"chat_id": chat_id, "min_id": min_id, "max_id": max_id}
+
+    token_ttl = timedelta(hours=6)
+    users = [
+        {"id": user_id, "username": username,
+         "token": create_access_token({"sub": username, "uid": user_id}, expires_delta=token_ttl)}
+        for user_id, username in zip(user_ids, usernames)
+    ]
+    return Dataset(run_id, users, chats_by_user, len(chat_ids), history_chats)
+
+
+# ----- Сервер -----
+
+def boot_server(args: argparse.Namespace) -> subprocess.Popen:
+    log = open(args.server_log, "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        stdout=log, stderr=subprocess.STDOUT, env=os.environ.copy(),
+    )
+
+
+async def wait_for_server(base_url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server at {base_url} did not start in {timeout} seconds")
+            await asyncio.sleep(0.2)
+
+
+# ----- WebSocket-клиенты -----
+
+@dataclass
+class TrafficStats:
+    measuring: bool = False
+    sent: int = 0
+    delivered: int = 0
+    errors: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+
+class SyntheticClient:
+    """Один пользователь: одно мультиплексированное соединение, подписка на все свои чаты."""
+
+    def __init__(self, ws_url: str, user: dict, chat_ids: List[int], stats: TrafficStats):
+        self.url = f"{ws_url}/ws?token={user['token']}"
+        self.chat_ids = chat_ids
+        self.stats = stats
+        self.websocket = None
+        self.subscribed = asyncio.Event()
+        self._pending_subscriptions = set(chat_ids)
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def connect(self) -> float:
+        started = time.monotonic()
+        self.websocket = await websockets.connect(self.url, open_timeout=60, ping_interval=None, max_size=2 ** 20)
+        self._reader_task = asyncio.create_task(self._read())
+        for chat_id in self.chat_ids:
+            await self.websocket.send(json.dumps({"type": "subscribe", "chat_id": chat_id}))
+        await asyncio.wait_for(self.subscribed.wait(), timeout=SUBSCRIBE_TIMEOUT_SECONDS)
+        return time.monotonic() - started
+
+    async def _read(self):
+        try:
+            async for raw in self.websocket:
+                frame = json.loads(raw)
+                frame_type = frame.get("type")
+                if frame_type == "message":
+                    content = frame.get("content", "")
+                    if self.stats.measuring and content.startswith(BENCH_CONTENT_PREFIX):
+                        self.stats.delivered += 1
+                        self.stats.latencies.append(time.monotonic() - float(content[len(BENCH_CONTENT_PREFIX):]))
+                elif frame_type == "ping":
+                    await self.websocket.send(json.dumps({"type": "pong"}))
+                elif frame_type == "subscribed":
+                    self._pending_subscriptions.discard(frame["chat_id"])
+                    if not self._pending_subscriptions:
+                        self.subscribed.set()
+                elif "error" in frame and self.stats.measuring:
+                    self.stats.errors += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_loop(self, rate: float, stop: asyncio.Event, rng: random.Random):
+        # Случайный сдвиг, чтобы клиенты не отправляли сообщения синхронно
+        await asyncio.sleep(rng.random() / rate)
+        while not stop.is_set():
+            chat_id = rng.choice(self.chat_ids)
+            content = f"{BENCH_CONTENT_PREFIX}{time.monotonic():.6f}"
+            try:
+                await self.websocket.send(json.dumps({"type": "message", "chat_id": chat_id, "content": content}))
+            except websockets.ConnectionClosed:
+                return
+            if self.stats.measuring:
+                self.stats.sent += 1
+            await asyncio.sleep(1 / rate)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self._reader_task is not None:
+            await self._reader_task
+
+
+async def run_websocket_phase(args, dataset: Dataset, ws_url: str, rng: random.Random) -> dict:
+    stats = TrafficStats()
+    clients = [
+        SyntheticClient(ws_url, user, dataset.chats_by_user[user["id"]], stats)
+        for user in dataset.users
+    ]
+
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    connect_times: List[float] = []
+    failed = 0
+
+    async def connect(client: SyntheticClient):
+        nonlocal failed
+        async with semaphore:
+            try:
+                connect_times.append(await client.connect())
+            except Exception as e:
+                failed += 1
+                print(f"Client connect failed: {e}")
+
+    started = time.monotonic()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_seconds = time.monotonic() - started
+    connected = [client for client in clients if client.subscribed.is_set()]
+
+    stop = asyncio.Event()
+    senders = [
+        asyncio.create_task(client.send_loop(args.send_rate, stop, random.Random(rng.random())))
+        for client in connected
+    ]
+    await asyncio.sleep(args.warmup)
+    stats.measuring = True
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*senders)
+    # Даем догнать сообщения, отправленные в конце окна
+    await asyncio.sleep(2)
+    stats.measuring = False
+    await asyncio.gather(*(client.close() for client in connected), return_exceptions=True)
+
+    return {
+        "connect": {
+            "clients": len(clients),
+            "failed": failed,
+            "seconds": round(connect_seconds, 3),
+            "per_second": round(len(connected) / connect_seconds, 2) if connect_seconds else None,
+            **latency_summary(connect_times),
+        },
+        "messages": {
+            "chats": dataset.chat_count,
+            "sent": stats.sent,
+            "delivered": stats.delivered,
+            "errors": stats.errors,
+            "sent_per_second": round(stats.sent / args.duration, 2),
+            "delivered_per_second": round(stats.delivered / args.duration, 2),
+            **latency_summary(stats.latencies),
+        },
+    }
+
+
+# ----- HTTP -----
+
+async def run_login_phase(args, dataset: Dataset, base_url: str, rng: random.Random) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    deadline = time.monotonic() + args.login_duration
+
+    async def worker(client: httpx.AsyncClient, worker_rng: random.Random):
+        while time.monotonic() < deadline:
+            user = worker_rng.choice(dataset.users)
+            started = time.monotonic()
+            response = await client.post("/auth/token", data={"username": user["username"], "password": BENCH_PASSWORD})
+            if response.status_code == 200:
+                latencies.append(time.monotonic() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    limits = httpx.Limits(max_connections=args.login_concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await asyncio.gather(*(
+            worker(client, random.Random(rng.random())) for _ in range(args.login_concurrency)
+        ))
+    return {
+        "succeeded": len(latencies),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "per_second": round(len(latencies) / args.login_duration, 2),
+        **latency_summary(latencies),
+    }
+
+
+async def run_history_phase(args, dataset: Dataset, base_url: str) -> dict:
+    headers = {"Authorization": f"Bearer {dataset.users[0]['token']}"}
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=60) as client:
+        for size, history in dataset.history_chats.items():
+            url = f"/api/chats/{history['chat_id']}/messages"
+            pages = {
+                "latest": {"limit": 50},
+                "deep": {"limit": 50, "before_id": (history["min_id"] + history["max_id"]) // 2},
+            }
+            summary = {}
+            for page, params in pages.items():
+                latencies = []
+                for _ in range(args.history_requests):
+                    started = time.monotonic()
+                    response = await client.get(url, params=params)
+                    response.raise_for_status()
+                    latencies.append(time.monotonic() - started)
+                summary.update({f"{page}_{key}": value for key, value in latency_summary(latencies).items()})
+            results[str(size)] = summary
+    return results
+
+
+# ----- Отчет и сравнение -----
+
+def print_report(results: dict):
+    connect, messages, login = results["connect"], results["messages"], results["login"]
+    print(f"\nConnect:   {connect['per_second']} conn/s ({connect['clients']} clients, {connect['failed']} failed), "
+          f"p50 {connect['p50_ms']} ms, p99 {connect['p99_ms']} ms")
+    print(f"Messages:  {messages['sent_per_second']} sent/s, {messages['delivered_per_second']} delivered/s "
+          f"across {messages['chats']} chats, p50 {messages['p50_ms']} ms, p99 {messages['p99_ms']} ms, "
+          f"{messages['errors']} errors")
+    print(f"Login:     {login['per_second']} req/s, p50 {login['p50_ms']} ms, p99 {login['p99_ms']} ms, "
+          f"statuses {login['statuses']}")
+    for size, history in results["history"].items():
+        print(f"History {size}: latest p50 {history['latest_p50_ms']} / p99 {history['latest_p99_ms']} ms, "
+              f"deep p50 {history['deep_p50_ms']} / p99 {history['deep_p99_ms']} ms")
+
+
+def find_regressions(results: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Сравнивает метрики с baseline; возвращает описания регрессий."""
+    checks = [(section, key, higher_is_better) for (section, key), higher_is_better in GATED_METRICS.items()]
+    checks += [
+        ("history", (size, key), higher_is_better)
+        for size in results["history"] for key, higher_is_better in GATED_HISTORY_METRICS.items()
+    ]
+
+    regressions = []
+    for section, key, higher_is_better in checks:
+        if isinstance(key, tuple):
+            size, metric = key
+            current = results[section].get(size, {}).get(metric)
+            previous = baseline.get(section, {}).get(size, {}).get(metric)
+            name = f"{section}.{size}.{metric}"
+        else:
+            current = results[section].get(key)
+            previous = baseline.get(section, {}).get(key)
+            name = f"{section}.{key}"
+        if current is None or not previous:
+            continue
+        change = (previous - current) / previous if higher_is_better else (current - previous) / previous
+        if change > max_regression:
+            regressions.append(f"{name}: {previous} -> {current} ({change:+.1%} worse)")
+    return regressions
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    prepare_schema()
+    dataset = seed_dataset(args, rng)
+    print(f"Seeded run {dataset.run_id}: {len(dataset.users)} users, {dataset.chat_count} chats, "
+          f"history sizes {sorted(dataset.history_chats)}")
+
+    server = None
+    base_url = args.server_url
+    if base_url is None:
+        server = boot_server(args)
+        base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        await wait_for_server(base_url)
+        ws_url = "ws" + base_url[len("http"):]
+        results = {"run_id": dataset.run_id, "config": {
+            key: value for key, value in vars(args).items() if key not in ("database_url", "output", "baseline", "server_log")
+        }}
+        results.update(await run_websocket_phase(args, dataset, ws_url, rng))
+        results["login"] = await run_login_phase(args, dataset, base_url, rng)
+        results["history"] = await run_history_phase(args, dataset, base_url)
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    # Настройки приложения читаются при импорте app.*, поэтому переопределение - до импорта
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    raise_open_files_limit()
+
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.max_regression)
+        if regressions:
+            print("\nPerformance regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions beyond {args.max_regression:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())